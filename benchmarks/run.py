@@ -0,0 +1,224 @@
+# Benchmarks for dataset construction, subsetting, and targets
+#
+# Synthetic metadata is generated (once) in the real dataset layouts at
+# several scales, and the time and peak (Python-tracked) memory of each
+# operation is measured. Example:
+#
+#   python -m benchmarks.run --scales small medium --save baseline.json
+#   python -m benchmarks.run --scales small medium --baseline baseline.json
+#
+# When comparing against a baseline, the exit status is 1 if any
+# operation is slower than the baseline by more than the tolerance.
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+import jaffadata as jd
+from jaffadata.datasets import audioset, fsd50k, tau_nigens
+from jaffadata.datasets import AudioSet, FSD50K, TauNigens2020
+
+from . import synthetic
+
+
+SCALES = {
+    'small': {'audioset': 20_000, 'fsd50k': 5_000, 'tau': 12},
+    'medium': {'audioset': 200_000, 'fsd50k': 50_000, 'tau': 60},
+    'large': {'audioset': 2_000_000, 'fsd50k': 200_000, 'tau': 240},
+}
+
+
+def audioset_cases(root_dir):
+    dataset = AudioSet(root_dir)
+    train_set = dataset['training']
+    fnames = _sample(train_set.tags.index, 256)
+    csv_path = root_dir / 'unbalanced_train_segments.csv'
+
+    def construct():
+        dataset = AudioSet(root_dir)
+        return dataset['training'], dataset['evaluation']
+
+    return {
+        'read_tags': lambda: audioset.read_tags(csv_path, dataset.ontology),
+        'construct': construct,
+        'subset': lambda: train_set.subset(
+            'labels has "Label 3" | labels has "Label 9"').tags,
+        'loc': lambda: train_set.loc[fnames].tags,
+        'concat': lambda: jd.concat([dataset['training/unbalanced'],
+                                     dataset['training/balanced']]).tags,
+        'audio_paths': lambda: _fresh(train_set).audio_paths,
+        'target': lambda: train_set.target(fmt='array'),
+        'target_sparse': lambda: train_set.target(fmt='sparse'),
+        'target_ancestors': lambda: train_set.target(ancestors=True,
+                                                     fmt='sparse'),
+    }
+
+
+def fsd50k_cases(root_dir):
+    dataset = FSD50K(root_dir)
+    train_set = dataset['training']
+    fnames = _sample(train_set.tags.index, 256)
+    csv_path = root_dir / 'FSD50K.ground_truth' / 'dev.csv'
+
+    return {
+        'read_tags': lambda: fsd50k.read_tags(csv_path),
+        'construct': lambda: FSD50K(root_dir),
+        'subset': lambda: train_set.subset('labels has Label_0').tags,
+        'loc': lambda: train_set.loc[fnames].tags,
+        'concat': lambda: jd.concat([dataset['train'], dataset['val'],
+                                     dataset['eval']]).tags,
+        'audio_paths': lambda: _fresh(train_set).audio_paths,
+        'target': lambda: train_set.target(),
+        'target_sparse': lambda: train_set.target(fmt='sparse'),
+    }
+
+
+def tau_cases(root_dir):
+    dataset = TauNigens2020(root_dir)
+    train_set = dataset['training']
+    fnames = _sample(train_set.tags.index.unique(level=0), 4)
+    metadata_dir = root_dir / 'metadata_dev'
+
+    def construct():
+        dataset = TauNigens2020(root_dir)
+        return dataset['training'], dataset['validation'], dataset['test']
+
+    return {
+        'read_tags': lambda: tau_nigens.read_dev_tags(metadata_dir, ov=True),
+        'construct': construct,
+        'subset': lambda: train_set.subset('label in [0, 1, 2]').tags,
+        'loc': lambda: train_set.loc[fnames].tags,
+        'concat': lambda: jd.concat([dataset['mic_dev/training'],
+                                     dataset['mic_dev/validation']]).tags,
+        'audio_paths': lambda: _fresh(train_set).audio_paths,
+        'target': lambda: train_set.target(fmt='array', doa=True),
+        'target_frame': lambda: train_set.target(),
+    }
+
+
+DATASETS = {
+    'audioset': (synthetic.make_audioset, audioset_cases),
+    'fsd50k': (synthetic.make_fsd50k, fsd50k_cases),
+    'tau': (synthetic.make_tau, tau_cases),
+}
+
+
+def run(scales, datasets, data_dir, repeat=3, ops=None):
+    # Return a dict mapping 'scale/dataset/op' to the measurements
+    results = {}
+    for scale in scales:
+        for name in datasets:
+            size = SCALES[scale][name]
+            make_fn, cases_fn = DATASETS[name]
+            root_dir = _generate(make_fn, data_dir / name / str(size), size)
+            for op, fn in cases_fn(root_dir).items():
+                if ops and op not in ops:
+                    continue
+                key = f'{scale}/{name}/{op}'
+                results[key] = measure(fn, repeat)
+                print(f'{key:<40} {results[key]["time"]:>10.4f} s '
+                      f'{results[key]["peak_mb"]:>10.1f} MB', flush=True)
+    return results
+
+
+def measure(fn, repeat=3):
+    # Return the best time and the peak memory usage of a function
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured separately as tracing slows down execution
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time': min(times), 'peak_mb': peak / 2 ** 20}
+
+
+def compare(results, baseline, tolerance=0.2):
+    # Return the keys of the operations that regressed
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ['time', 'peak_mb']:
+            old, new = baseline[key][metric], result[metric]
+            ratio = new / old if old > 0 else 1
+            if ratio > 1 + tolerance:
+                regressions.append(key)
+                print(f'REGRESSION {key} {metric}: {old:.4f} -> '
+                      f'{new:.4f} ({ratio:.2f}x)')
+    return regressions
+
+
+def _generate(make_fn, root_dir, size):
+    # Generate the metadata unless it has already been generated
+    marker = root_dir / '.complete'
+    if not marker.is_file():
+        print(f'Generating {root_dir}', flush=True)
+        make_fn(root_dir, size)
+        marker.touch()
+    return root_dir
+
+
+def _fresh(subset):
+    # Return a copy of a subset without its cached properties
+    return subset.subset_iloc(slice(None))
+
+
+def _sample(index, n):
+    rng = np.random.default_rng(0)
+    return list(index[rng.choice(len(index), min(n, len(index)),
+                                 replace=False)])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', default=['small'],
+                        choices=list(SCALES))
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS),
+                        choices=list(DATASETS))
+    parser.add_argument('--ops', nargs='+',
+                        help='only run these operations (e.g. target)')
+    parser.add_argument('--data_dir', type=Path,
+                        default=Path(tempfile.gettempdir())
+                        / 'jaffadata-benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', type=Path,
+                        help='write the results to this JSON file')
+    parser.add_argument('--save', type=Path,
+                        help='write the results as a baseline')
+    parser.add_argument('--baseline', type=Path,
+                        help='compare the results against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(args)
+
+    # Metadata caching would make the construction timings meaningless
+    jd.set_cache_dir(None)
+
+    results = run(args.scales, args.datasets, args.data_dir,
+                  args.repeat, args.ops)
+    for path in [args.output, args.save]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
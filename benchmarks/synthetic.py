@@ -0,0 +1,112 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def make_audioset(root_dir, n_rows, n_classes=527, seed=0):
+    # Create AudioSet-style metadata with `n_rows` unbalanced clips
+    root_dir = Path(root_dir)
+    rng = np.random.default_rng(seed)
+
+    # Create a tree-shaped ontology with up to 8 children per node
+    mids = [f'/m/{i:05d}' for i in range(n_classes)]
+    children = [[] for _ in range(n_classes)]
+    for i in range(1, n_classes):
+        children[(i - 1) // 8].append(mids[i])
+    ontology = [{'id': mid, 'name': f'Label {i}', 'child_ids': child_ids}
+                for i, (mid, child_ids) in enumerate(zip(mids, children))]
+    root_dir.mkdir(parents=True, exist_ok=True)
+    with open(root_dir / 'ontology.json', 'w') as f:
+        json.dump(ontology, f)
+
+    n_small = max(n_rows // 40, 100)
+    splits = [
+        ('balanced_train_segments.csv', 'balanced_train', n_small),
+        ('unbalanced_train_segments.csv', 'unbalanced_train', n_rows),
+        ('eval_segments.csv', 'eval', n_small),
+    ]
+    for csv_name, audio_dir, n in splits:
+        (root_dir / audio_dir).mkdir(exist_ok=True)
+        labels = _label_strings(rng, mids, n)
+        ytids = [f'{audio_dir[0]}{i:010d}' for i in range(n)]
+        with open(root_dir / csv_name, 'w') as f:
+            f.write('# Segments csv created synthetically\n')
+            f.write(f'# num_ytids={n}, num_segs={n}\n')
+            f.write('# YTID, start_seconds, end_seconds, positive_labels\n')
+            f.writelines(f'{ytid}, 0.000, 10.000, "{label}"\n'
+                         for ytid, label in zip(ytids, labels))
+
+
+def make_fsd50k(root_dir, n_rows, n_classes=200, seed=0):
+    # Create FSD50K-style ground truth with `n_rows` dev clips
+    root_dir = Path(root_dir)
+    rng = np.random.default_rng(seed)
+    gt_dir = root_dir / 'FSD50K.ground_truth'
+    gt_dir.mkdir(parents=True, exist_ok=True)
+    (root_dir / 'FSD50K.dev_audio').mkdir(exist_ok=True)
+    (root_dir / 'FSD50K.eval_audio').mkdir(exist_ok=True)
+
+    labels = [f'Label_{i}' for i in range(n_classes)]
+    mids = [f'/m/{i:05d}' for i in range(n_classes)]
+    pd.DataFrame({'label': labels, 'mid': mids}).to_csv(
+        gt_dir / 'vocabulary.csv', header=False)
+
+    for name, n in [('dev', n_rows), ('eval', max(n_rows // 5, 100))]:
+        codes = _label_codes(rng, n_classes, n)
+        df = pd.DataFrame({
+            'fname': np.arange(n),
+            'labels': [','.join(labels[c] for c in row) for row in codes],
+            'mids': [','.join(mids[c] for c in row) for row in codes],
+        })
+        if name == 'dev':
+            df['split'] = np.where(rng.random(n) < 0.9, 'train', 'val')
+        df.to_csv(gt_dir / f'{name}.csv', index=False)
+
+
+def make_tau(root_dir, n_files, n_frames=600, n_classes=14, seed=0):
+    # Create TAU-NIGENS 2020-style metadata with `n_files` dev files
+    root_dir = Path(root_dir)
+    rng = np.random.default_rng(seed)
+    for name in ['mic_dev', 'foa_dev', 'mic_eval', 'foa_eval']:
+        (root_dir / name).mkdir(parents=True, exist_ok=True)
+
+    dev_dir = root_dir / 'metadata_dev'
+    eval_dir = root_dir / 'metadata_eval'
+    dev_dir.mkdir(exist_ok=True)
+    eval_dir.mkdir(exist_ok=True)
+    for i in range(n_files):
+        fname = (f'fold{i % 6 + 1}_room{i % 2 + 1}'
+                 f'_mix{i // 6 + 1:03d}_ov{i % 2 + 1}.csv')
+        _frame_events(rng, n_frames, n_classes).to_csv(
+            dev_dir / fname, header=False, index=False)
+    for i in range(max(n_files // 3, 1)):
+        _frame_events(rng, n_frames, n_classes).to_csv(
+            eval_dir / f'mix{i + 1:03d}.csv', header=False, index=False)
+
+
+def _label_codes(rng, n_classes, n):
+    # Sample 1-3 labels for each row from a long-tailed distribution
+    n_labels = rng.integers(1, 4, n)
+    codes = np.minimum(rng.zipf(1.3, n_labels.sum()) - 1, n_classes - 1)
+    return np.split(codes, np.cumsum(n_labels)[:-1])
+
+
+def _label_strings(rng, mids, n):
+    return [','.join(mids[c] for c in row)
+            for row in _label_codes(rng, len(mids), n)]
+
+
+def _frame_events(rng, n_frames, n_classes):
+    # Each frame has 0-2 active events
+    n_events = rng.integers(0, 3, n_frames)
+    frames = np.repeat(np.arange(n_frames), n_events)
+    return pd.DataFrame({
+        'frame': frames,
+        'label': rng.integers(0, n_classes, len(frames)),
+        'track': np.arange(len(frames)) - np.repeat(
+            np.cumsum(n_events) - n_events, n_events),
+        'azimuth': rng.integers(-180, 181, len(frames)),
+        'elevation': rng.integers(-45, 46, len(frames)),
+    })
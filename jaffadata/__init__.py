@@ -1,7 +1,14 @@
 import importlib.metadata
 
+from jaffadata.core import profiling
+from jaffadata.core.cache import set_cache_dir
 from jaffadata.core.dataset import AudioDataset, Dataset, DataSubset
+from jaffadata.core.features import FeatureCache, LogMel, Spectrogram
 from jaffadata.core.labels import binarize
+from jaffadata.core.multilabel import MultiLabelArray, MultiLabelDtype
+from jaffadata.core.packed import PackedAudio
+from jaffadata.core.sampling import BalancedSampler, WeightedSampler
+from jaffadata.core.shared import SharedSubset
 
 
 concat = DataSubset.concat
@@ -11,8 +18,19 @@ __version__ = importlib.metadata.version(__name__)
 __all__ = [
     '__version__',
     'AudioDataset',
+    'BalancedSampler',
     'Dataset',
     'DataSubset',
+    'FeatureCache',
+    'LogMel',
+    'MultiLabelArray',
+    'MultiLabelDtype',
+    'PackedAudio',
+    'SharedSubset',
+    'Spectrogram',
+    'WeightedSampler',
     'binarize',
     'concat',
+    'profiling',
+    'set_cache_dir',
 ]
@@ -0,0 +1,397 @@
+import collections
+import functools
+import hashlib
+import math
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .cache import get_cache_dir, write_pickle
+from .parallel import imap
+
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg', '.opus', '.mp3', '.sph')
+
+
+AudioInfo = collections.namedtuple('AudioInfo', [
+    'duration',
+    'n_channels',
+    'sample_rate',
+    'bit_depth',
+    'n_samples',
+    'size',
+])
+
+
+def list_audio(audio_dir, recursive=False):
+    # Return the relative paths of the audio files in a directory
+    #
+    # If a cache directory has been set, the listing is stored in a
+    # manifest and reused for as long as the modification times of the
+    # scanned directories are unchanged.
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return _scan(audio_dir, recursive)[0]
+
+    key = f'{Path(audio_dir).resolve()}:{recursive}'
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    manifest_path = cache_dir / 'manifests' / f'{key}.pkl'
+    if manifest_path.is_file():
+        fnames, dir_mtimes = pd.read_pickle(manifest_path)
+        if all(_mtime(path) == mtime for path, mtime in dir_mtimes.items()):
+            return fnames
+
+    fnames, dir_mtimes = _scan(audio_dir, recursive)
+    write_pickle((fnames, dir_mtimes), manifest_path)
+    return fnames
+
+
+def probe(path):
+    # Read the properties of an audio file from its header
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            info = _probe_wav(f)
+        elif header[:4] == b'fLaC':
+            f.seek(4)
+            info = _probe_flac(f)
+        else:
+            info = _probe_other(path)
+
+    n_channels, sample_rate, bit_depth, n_samples = info
+    return AudioInfo(duration=n_samples / sample_rate,
+                     n_channels=n_channels,
+                     sample_rate=sample_rate,
+                     bit_depth=bit_depth,
+                     n_samples=n_samples,
+                     size=os.path.getsize(path),
+                     )
+
+
+def probe_paths(paths, n_workers=None, processes=False, index_dir=None):
+    # Probe the given audio files and return the results as a DataFrame
+    #
+    # If `index_dir` is given (or a cache directory has been set), the
+    # results are stored in a persistent index for each directory, and
+    # files are only probed again if their modification time or size
+    # has changed since they were indexed.
+    paths = pd.Index(map(str, paths))
+    if index_dir is None and get_cache_dir() is not None:
+        index_dir = get_cache_dir() / 'audio_index'
+    if index_dir is None:
+        infos = imap(probe, paths, n_workers, processes)
+        return pd.DataFrame(list(infos), index=paths,
+                            columns=AudioInfo._fields)
+
+    index_dir = Path(index_dir)
+    dirs = pd.Series(paths.map(os.path.dirname), index=paths)
+    results = [_probe_dir(audio_dir, group.index, index_dir,
+                          n_workers, processes)
+               for audio_dir, group in dirs.groupby(dirs, sort=False)]
+    return pd.concat(results).loc[paths, list(AudioInfo._fields)]
+
+
+def load(path, sample_rate=None, start=0, end=None, n_channels=None):
+    # Decode (part of) an audio file as a float32 array with shape
+    # (n_channels, n_samples)
+    #
+    # `start` and `end` are given in seconds. If `sample_rate` is given,
+    # the audio is resampled if necessary. If `n_channels` is 1, audio
+    # with more than one channel is downmixed.
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            x, orig_sample_rate = _read_wav(f, start, end)
+        else:
+            x, orig_sample_rate = _read_other(path, start, end)
+
+    if n_channels == 1 and len(x) > 1:
+        x = x.mean(axis=0, keepdims=True)
+    if sample_rate is not None and sample_rate != orig_sample_rate:
+        x = resample(x, orig_sample_rate, sample_rate)
+    return x
+
+
+def resample(x, orig_sample_rate, sample_rate):
+    try:
+        from scipy.signal import resample_poly
+    except ImportError:
+        raise ValueError('Resampling audio requires scipy') from None
+
+    gcd = math.gcd(int(orig_sample_rate), int(sample_rate))
+    x = resample_poly(x, sample_rate // gcd, orig_sample_rate // gcd,
+                      axis=-1)
+    return x.astype(np.float32)
+
+
+def fix_length(x, n_samples):
+    # Pad (with zeros) or crop the last axis to length `n_samples`
+    if x.shape[-1] >= n_samples:
+        return x[..., :n_samples]
+    padding = [(0, 0)] * (x.ndim - 1) + [(0, n_samples - x.shape[-1])]
+    return np.pad(x, padding)
+
+
+class AudioLoader:
+    # Iterable that decodes audio clips in batches
+    #
+    # Each batch is decoded by one of `n_workers` threads or processes,
+    # and up to `prefetch` batches are decoded ahead of the consumer.
+    # Batches are float32 arrays with shape (batch_size, n_channels,
+    # n_samples). If `clip_duration` is given, clips are padded or
+    # cropped to that duration. Otherwise, clips are padded to the
+    # length of the longest clip in the batch.
+    #
+    # If `store` is given (e.g. a PackedAudio instance), `paths` are the
+    # positions of the clips in the store rather than file paths.
+    def __init__(self,
+                 paths,
+                 starts=None,
+                 ends=None,
+                 sample_rate=None,
+                 clip_duration=None,
+                 n_channels=None,
+                 batch_size=32,
+                 n_workers=None,
+                 processes=False,
+                 prefetch=None,
+                 drop_last=False,
+                 store=None,
+                 ):
+        self.paths = np.asarray(paths, dtype=str if store is None else None)
+        self.starts = starts
+        self.ends = ends
+        self.sample_rate = sample_rate
+        self.clip_duration = clip_duration
+        self.n_channels = n_channels
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.processes = processes
+        self.prefetch = prefetch
+        self.drop_last = drop_last
+        self.store = store
+
+        self.n_samples = None
+        if clip_duration is not None and sample_rate is not None:
+            self.n_samples = round(clip_duration * sample_rate)
+
+    def batches(self, positions=None):
+        # Generate batches for the given row positions
+        #
+        # `positions` may also be an iterable of arrays of positions
+        # (e.g. the batches of a sampler), in which case each array of
+        # positions is decoded as one batch.
+        if positions is None:
+            positions = np.arange(len(self.paths))
+        if isinstance(positions, (np.ndarray, list)):
+            positions = self._split(np.asarray(positions))
+
+        load_batch = functools.partial(_load_batch,
+                                       sample_rate=self.sample_rate,
+                                       n_channels=self.n_channels,
+                                       n_samples=self.n_samples,
+                                       store=self.store)
+        items = map(self._items, positions)
+        yield from imap(load_batch, items, self.n_workers,
+                        self.processes, self.prefetch)
+
+    def _split(self, positions):
+        n_batches = len(positions) // self.batch_size
+        if not self.drop_last:
+            n_batches = math.ceil(len(positions) / self.batch_size)
+        for i in range(n_batches):
+            yield positions[i * self.batch_size:(i + 1) * self.batch_size]
+
+    def _items(self, positions):
+        # Only the arguments for the given rows are sent to the workers
+        return [(self.paths[i],
+                 0 if self.starts is None else self.starts[i],
+                 None if self.ends is None else self.ends[i])
+                for i in positions]
+
+    def __getitem__(self, index):
+        item, = self._items([index])
+        return _load_batch([item], self.sample_rate, self.n_channels,
+                           self.n_samples, self.store)[0]
+
+    def __iter__(self):
+        return self.batches()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.paths) // self.batch_size
+        return math.ceil(len(self.paths) / self.batch_size)
+
+
+def _probe_dir(audio_dir, paths, index_dir, n_workers, processes):
+    key = hashlib.sha1(str(Path(audio_dir).resolve()).encode()).hexdigest()
+    index_path = index_dir / f'{key[:16]}.pkl'
+    if index_path.is_file():
+        index = pd.read_pickle(index_path)
+    else:
+        index = pd.DataFrame(columns=['mtime', *AudioInfo._fields],
+                             dtype=float)
+
+    stats = [os.stat(path) for path in paths]
+    mtimes = np.array([stat.st_mtime_ns for stat in stats])
+    sizes = np.array([stat.st_size for stat in stats])
+
+    # Determine which files are new or have been modified
+    indexed = index.reindex(paths)
+    stale = ((indexed.mtime.values != mtimes)
+             | (indexed['size'].values != sizes))
+    if not stale.any():
+        return indexed
+
+    stale_paths = paths[stale]
+    infos = imap(probe, stale_paths, n_workers, processes)
+    probed = pd.DataFrame(list(infos), index=stale_paths,
+                          columns=AudioInfo._fields)
+    probed.insert(0, 'mtime', mtimes[stale])
+
+    index = index.drop(stale_paths, errors='ignore')
+    index = probed if len(index) == 0 else pd.concat([index, probed])
+    write_pickle(index, index_path)
+    return index.loc[paths]
+
+
+def _load_batch(items, sample_rate, n_channels, n_samples, store=None):
+    load_fn = load if store is None else store.load
+    clips = [load_fn(path, sample_rate, start, end, n_channels)
+             for path, start, end in items]
+    if n_samples is None:
+        n_samples = max(clip.shape[-1] for clip in clips)
+    return np.stack([fix_length(clip, n_samples) for clip in clips])
+
+
+def _scan(audio_dir, recursive):
+    # Use os.scandir to avoid creating a Path object for every entry
+    fnames = []
+    dir_mtimes = {}
+    rel_dirs = ['']
+    while rel_dirs:
+        rel_dir = rel_dirs.pop()
+        path = os.path.join(audio_dir, rel_dir)
+        dir_mtimes[path] = _mtime(path)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name = rel_dir + entry.name
+                if recursive and entry.is_dir():
+                    rel_dirs.append(name + '/')
+                elif os.path.splitext(name)[1] in AUDIO_EXTENSIONS:
+                    fnames.append(name)
+
+    return sorted(fnames), dir_mtimes
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _probe_wav(f):
+    fmt, _, data_size = _wav_chunks(f)
+    _, n_channels, sample_rate, _, block_align, bit_depth = \
+        struct.unpack('<HHIIHH', fmt[:16])
+    return n_channels, sample_rate, bit_depth, data_size // block_align
+
+
+def _wav_chunks(f):
+    # Return the fmt chunk and the offset and size of the data chunk
+    fmt = None
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError('Invalid WAV file: missing data chunk')
+
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size)
+            f.seek(chunk_size % 2, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError('Invalid WAV file: missing fmt chunk')
+            return fmt, f.tell(), chunk_size
+        else:
+            # Chunks are padded to an even number of bytes
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def _probe_flac(f):
+    # The STREAMINFO block is always the first metadata block
+    block_header = f.read(4)
+    if len(block_header) < 4 or block_header[0] & 0x7F != 0:
+        raise ValueError('Invalid FLAC file: missing STREAMINFO block')
+
+    info = int.from_bytes(f.read(34)[10:18], 'big')
+    sample_rate = info >> 44
+    n_channels = ((info >> 41) & 0x7) + 1
+    bit_depth = ((info >> 36) & 0x1F) + 1
+    n_samples = info & 0xFFFFFFFFF
+    return n_channels, sample_rate, bit_depth, n_samples
+
+
+def _probe_other(path):
+    try:
+        import soundfile
+    except ImportError:
+        raise ValueError(f'Unsupported audio format: {path}') from None
+
+    info = soundfile.info(str(path))
+    bit_depth = {'PCM_S8': 8, 'PCM_U8': 8, 'PCM_16': 16, 'PCM_24': 24,
+                 'PCM_32': 32, 'FLOAT': 32, 'DOUBLE': 64}
+    return (info.channels, info.samplerate,
+            bit_depth.get(info.subtype), info.frames)
+
+
+def _read_wav(f, start, end):
+    fmt, data_offset, data_size = _wav_chunks(f)
+    fmt_tag, n_channels, sample_rate, _, block_align, bit_depth = \
+        struct.unpack('<HHIIHH', fmt[:16])
+    if fmt_tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE stores the format in the sub-format
+        fmt_tag, = struct.unpack('<H', fmt[24:26])
+
+    # Only read the requested frames
+    n_frames = data_size // block_align
+    first = min(round(start * sample_rate), n_frames)
+    last = n_frames if end is None else round(end * sample_rate)
+    last = max(min(last, n_frames), first)
+    f.seek(data_offset + first * block_align)
+    data = f.read((last - first) * block_align)
+
+    width = block_align // n_channels
+    if fmt_tag == 3 and width in (4, 8):
+        x = np.frombuffer(data, dtype=f'<f{width}')
+    elif fmt_tag == 1 and width == 1:
+        x = (np.frombuffer(data, dtype=np.uint8) / 128) - 1
+    elif fmt_tag == 1 and width in (2, 4):
+        x = np.frombuffer(data, dtype=f'<i{width}') / 2 ** (8 * width - 1)
+    elif fmt_tag == 1 and width == 3:
+        # Shift each 24-bit sample into the upper bytes of an int32
+        samples = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+        samples[:, 1:] = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        x = samples.view('<i4').ravel() / 2 ** 31
+    else:
+        raise ValueError(f'Unsupported WAV format: {fmt_tag}')
+
+    x = x.astype(np.float32).reshape(-1, n_channels).T
+    return x, sample_rate
+
+
+def _read_other(path, start, end):
+    try:
+        import soundfile
+    except ImportError:
+        raise ValueError(f'Unsupported audio format: {path}') from None
+
+    sample_rate = soundfile.info(str(path)).samplerate
+    stop = None if end is None else round(end * sample_rate)
+    x, _ = soundfile.read(str(path), start=round(start * sample_rate),
+                          stop=stop, dtype='float32', always_2d=True)
+    return x.T, sample_rate
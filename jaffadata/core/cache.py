@@ -0,0 +1,74 @@
+import functools
+import hashlib
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+_cache_dir = os.environ.get('JAFFADATA_CACHE_DIR')
+
+
+def set_cache_dir(path):
+    global _cache_dir
+    _cache_dir = path
+
+
+def get_cache_dir():
+    if _cache_dir is None:
+        return None
+    return Path(_cache_dir)
+
+
+def cached(key_fn):
+    # Decorator for caching the return value of a metadata reader
+    #
+    # `key_fn` is called with the arguments of the reader and must
+    # return a list of items that identify the return value. Items that
+    # are paths (not strings) are identified by their modification time
+    # and size, so the cache is invalidated whenever a source file
+    # changes. Key functions should therefore convert paths given as
+    # strings using Path.
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache_dir = get_cache_dir()
+            if cache_dir is None:
+                return fn(*args, **kwargs)
+
+            key = _key(fn, key_fn(*args, **kwargs))
+            path = cache_dir / f'{fn.__module__}.{fn.__name__}.{key}.pkl'
+            if path.is_file():
+                return pd.read_pickle(path)
+
+            value = fn(*args, **kwargs)
+
+            write_pickle(value, path)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def write_pickle(obj, path):
+    # Write to a temporary file first so that concurrent processes
+    # never read a partially-written file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    pd.to_pickle(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _key(fn, items):
+    from jaffadata import __version__
+
+    parts = [__version__, fn.__module__, fn.__qualname__]
+    for item in items:
+        if isinstance(item, os.PathLike):
+            item = Path(item)
+            stat = item.stat()
+            item = (str(item.resolve()), stat.st_mtime_ns, stat.st_size)
+        parts.append(repr(item))
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()[:16]
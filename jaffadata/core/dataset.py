@@ -1,10 +1,23 @@
 import functools
+import json
+import os
 import warnings
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
+from .audio import AudioLoader, list_audio, probe_paths
+from .cache import write_pickle
+from .features import extract_features
+from .labels import load_targets
 from .mask import FrameMask
+from .packed import PackedAudio
+from .profiling import instrument
+from .sampling import BalancedSampler, WeightedSampler, instance_weights
+from .shared import SharedSubset
+from .split import kfold
 
 
 class Dataset:
@@ -17,15 +30,46 @@ class Dataset:
         self.label_set = label_set
         self.subsets = dict()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Record the construction of each dataset when profiling
+        if '__init__' in cls.__dict__:
+            init = instrument(f'{cls.__name__}.__init__',
+                              rows=cls._n_rows)(cls.__init__)
+            cls.__init__ = init
+
+    def _n_rows(self):
+        # Return the number of rows of the subsets that have been
+        # created (i.e. are not Lazy), counting aliases of a subset once
+        subsets = {id(subset): subset for subset in self.subsets.values()
+                   if not isinstance(subset, Lazy)}
+        return sum(len(subset) for subset in subsets.values())
+
     @staticmethod
-    def target(subset, index=None):
+    def target(subset, index=None, **kwargs):
         raise NotImplementedError
 
+    @staticmethod
+    def target_store(subset, **kwargs):
+        # Return the targets of a subset in a form that supports
+        # gathering the targets of a batch of rows (see DataSubset),
+        # along with the keys (an Index) of the targets in the store
+        store = subset.dataset.target(subset, fmt='store', **kwargs)
+        return store, subset._index()
+
     def add_subset(self, subset):
         self.subsets[subset.name] = subset
 
     def __getitem__(self, key):
-        return self.subsets[key]
+        subset = self.subsets[key]
+        if isinstance(subset, Lazy):
+            # Create the subset and replace the placeholder everywhere,
+            # including under any aliases of the same placeholder
+            lazy, subset = subset, subset()
+            for name, value in self.subsets.items():
+                if value is lazy:
+                    self.subsets[name] = subset
+        return subset
 
     def __setitem__(self, key, value):
         self.subsets[key] = value
@@ -43,6 +87,36 @@ class Dataset:
         return self.name
 
 
+class Lazy:
+    # Deferred call to fn(*args, **kwargs) whose result is memoized
+    #
+    # Datasets can register Lazy objects as subsets, so that a subset
+    # (and the metadata it is created from) is only loaded when it is
+    # first accessed. Arguments that are Lazy objects are resolved
+    # before calling `fn`, so they can be used to share work (e.g.
+    # reading a metadata file) between subsets.
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.resolved = False
+        self.value = None
+
+    def __call__(self):
+        if not self.resolved:
+            args = [_resolve(arg) for arg in self.args]
+            kwargs = {key: _resolve(arg) for key, arg in self.kwargs.items()}
+            self.value = self.fn(*args, **kwargs)
+            self.resolved = True
+            # Release the arguments as they are no longer needed
+            self.fn = self.args = self.kwargs = None
+        return self.value
+
+
+def _resolve(arg):
+    return arg() if isinstance(arg, Lazy) else arg
+
+
 class AudioDataset(Dataset):
     def __init__(self,
                  name,
@@ -62,7 +136,9 @@ class AudioDataset(Dataset):
 
 
 class DataSubset:
-    def __init__(self, name, dataset, tags=None, audio_dir=None):
+    @instrument(rows=len)
+    def __init__(self, name, dataset, tags=None, audio_dir=None,
+                 recursive=False):
         if audio_dir is None:
             audio_dir = dataset.root_dir
         else:
@@ -82,27 +158,68 @@ class DataSubset:
         # One or more private tags are stored in self._tags
         if tags is None:
             # Create an empty DataFrame if no tags are given
-            extensions = ['.wav', '.flac', '.ogg', '.opus', '.mp3', '.sph']
-            index = pd.Index([path.name for path in audio_dir.iterdir()
-                              if path.suffix in extensions])
-            self.tags = pd.DataFrame(index=index)
-            self._tags = pd.DataFrame(index=self.tags.index)
+            index = pd.Index(list_audio(audio_dir, recursive))
+            tags = pd.DataFrame(index=index)
+            private_tags = pd.DataFrame(index=tags.index)
         elif isinstance(tags, tuple) and len(tags) == 2:
-            self.tags = _copy_tags(tags[0])
-            self._tags = _copy_tags(tags[1])
+            tags, private_tags = map(_copy_tags, tags)
         else:
-            self.tags = _copy_tags(tags)
-            self._tags = pd.DataFrame(index=self.tags.index)
+            tags = _copy_tags(tags)
+            private_tags = pd.DataFrame(index=tags.index)
 
-        if 'audio_dir' not in self._tags:
+        if 'audio_dir' not in private_tags:
             # Record the audio directory as a private tag
-            self._tags['audio_dir'] = audio_dir
+            # It is stored as a categorical so that each directory is
+            # only stored once, along with an integer code for each row
+            codes = np.zeros(len(private_tags), dtype=np.int8)
+            private_tags['audio_dir'] = pd.Categorical.from_codes(
+                codes, categories=[str(audio_dir)])
+        elif not isinstance(private_tags.audio_dir.dtype,
+                            pd.CategoricalDtype):
+            private_tags['audio_dir'] = \
+                private_tags.audio_dir.astype(str).astype('category')
+
+        self._frames = (tags, private_tags)
+        self.audio_store = None
+        self.frame_tags = None
+
+    @classmethod
+    def _view(cls, name, dataset, frames, audio_store=None, frame_tags=None):
+        # Create a subset that takes ownership of the given tag frames
+        #
+        # Unlike __init__, the frames are not copied again, so they
+        # must not be referenced elsewhere (e.g. by another subset).
+        subset = cls.__new__(cls)
+        subset.name = name
+        subset.dataset = dataset
+        subset._frames = frames
+        subset.audio_store = audio_store
+        subset.frame_tags = frame_tags
+        return subset
+
+    @property
+    def tags(self):
+        return self._frames[0]
+
+    @tags.setter
+    def tags(self, tags):
+        self._frames = (tags, self._frames[1])
+        # Targets computed from the old tags are no longer valid
+        self.__dict__.pop('_target_stores', None)
+
+    @property
+    def _tags(self):
+        return self._frames[1]
+
+    @_tags.setter
+    def _tags(self, private_tags):
+        self._frames = (self._frames[0], private_tags)
 
     def __getitem__(self, key):
         return self.subset(key)
 
     def __len__(self):
-        return len(self.tags)
+        return len(self._frames[0])
 
     def __str__(self):
         return f'{self.dataset} {self.name}'
@@ -116,56 +233,400 @@ class DataSubset:
         return _Indexer(lambda idx: self.subset_iloc(idx))
 
     @functools.cached_property
+    @instrument()
     def audio_paths(self):
-        audio_dirs = self._tags.audio_dir.groupby(level=0, sort=False).first()
-        fnames = self.tags.index.unique(level=0)
-        return audio_dirs / fnames
+        fnames = self._index().unique(level=0)
+        return pd.Series(map(Path, self.audio_path_array), index=fnames,
+                         name='audio_dir')
 
+    @functools.cached_property
+    @instrument()
+    def audio_path_array(self):
+        # Return the audio paths as an array of strings
+        # The paths are in the same order as the (unique) file names
+        fnames = self._index().get_level_values(0)
+        first = ~fnames.duplicated()
+        audio_dirs = self._tags.audio_dir.array
+        prefixes = np.array([audio_dir + os.sep
+                             for audio_dir in audio_dirs.categories],
+                            dtype=object)
+        paths = (prefixes[audio_dirs.codes[first]]
+                 + fnames[first].astype(str).values)
+        return paths.astype(str)
+
+    def audio_path(self, fname):
+        audio_dir = self._tags.audio_dir.loc[fname]
+        if isinstance(audio_dir, pd.Series):
+            audio_dir = audio_dir.iloc[0]
+        return Path(audio_dir) / fname
+
+    @instrument()
     def subset(self, mask, name=None, complement=False):
+        tags = self.tags
         if callable(mask):
-            mask = mask(self.tags)
+            mask = mask(tags)
         elif isinstance(mask, str):
-            mask = FrameMask(mask).value(self.tags)
+            mask = FrameMask(mask).value(tags)
         elif isinstance(mask, FrameMask):
-            mask = mask.value(self.tags)
-
+            mask = mask.value(tags)
+
+        if isinstance(mask, pd.Series):
+            # Align the mask with the tags as pandas would
+            index = self._index()
+            if not mask.index.equals(index):
+                mask = mask.reindex(index)
+                if mask.isna().any():
+                    raise pd.errors.IndexingError(
+                        'Unalignable boolean Series provided as indexer')
+
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != (len(self),):
+            raise ValueError(f'Item wrong length {mask.size} '
+                             f'instead of {len(self)}.')
         if complement:
             mask = ~mask
 
-        return self._subset(name, lambda tags: tags[mask])
+        return self._subset(name, np.flatnonzero(mask))
 
+    @instrument()
     def subset_loc(self, index, name=None):
-        return self._subset(name, lambda tags: tags.loc[index])
+        positions = pd.Series(np.arange(len(self)), index=self._index())
+        return self._subset(name, np.atleast_1d(positions.loc[index]))
 
+    @instrument()
     def subset_iloc(self, index, name=None):
-        return self._subset(name, lambda tags: tags.iloc[index])
+        return self._subset(name, np.atleast_1d(np.arange(len(self))[index]))
 
+    @instrument()
     def sample(self, n=None, name=None, **kwargs):
-        return self.subset_loc(name, self.tags.sample(n, **kwargs).index)
+        tags = self.tags
+        return self.subset_loc(tags.sample(n, **kwargs).index, name)
+
+    @instrument()
+    def target(self, index=None, **kwargs):
+        # If `index` is a list or array, the targets of the batch are
+        # returned as an array using precomputed targets, with the
+        # first dimension corresponding to the items of `index`.
+        # Integer arrays are interpreted as row positions. The targets
+        # are precomputed until `tags` is reassigned (see below).
+        if isinstance(index, tuple) or not pd.api.types.is_list_like(index):
+            return self.dataset.target(self, index, **kwargs)
+
+        if kwargs.pop('fmt', 'array') != 'array':
+            raise ValueError('Batched targets are only returned as arrays')
+
+        _, (store, keys) = self._target_store(kwargs)
+        positions = np.asarray(index)
+        if positions.ndim == 1 and positions.dtype.kind in 'iu':
+            return store[positions]
+
+        # Keys may be tuples (for a MultiIndex), so they are not
+        # converted to an array
+        index = list(index)
+        positions = keys.get_indexer(index)
+        if (positions < 0).any():
+            missing = [key for key, pos in zip(index, positions) if pos < 0]
+            raise KeyError(f'{missing} not in index')
+        return store[positions]
+
+    def _target_store(self, kwargs):
+        # Compute the targets once for each set of arguments
+        #
+        # The targets are only recomputed when `tags` is assigned, so
+        # after modifying the tags in place (e.g. `subset.tags.loc[...]
+        # = ...`), reassign them using `subset.tags = subset.tags`.
+        key = repr(sorted(kwargs.items()))
+        if key not in self._target_stores:
+            self._target_stores[key] = self.dataset.target_store(self,
+                                                                 **kwargs)
+        return key, self._target_stores[key]
 
-    def target(self, index=None):
-        return self.dataset.target(self, index)
+    @functools.cached_property
+    def _target_stores(self):
+        return {}
+
+    def sampler(self, balanced=False, y=None, reduce='max', seed=None,
+                **kwargs):
+        # Return a sampler that draws row positions with replacement
+        # The class weights are computed once from the targets, so the
+        # sampler can be reused for every epoch
+        if y is None:
+            _, (y, _) = self._target_store(kwargs)
+        if balanced:
+            return BalancedSampler(y, seed)
+        return WeightedSampler(instance_weights(y, reduce), seed)
+
+    @instrument()
+    def kfold(self, n_folds, stratify=None, groups=None, seed=None):
+        return kfold(self, n_folds, stratify, groups, seed)
+
+    @instrument()
+    def probe(self, n_workers=None, processes=False, index_dir=None):
+        audio_paths = self.audio_path_array
+        info = probe_paths(audio_paths, n_workers, processes, index_dir)
+        info.index = self._index().unique(level=0)
+
+        # Record the audio properties as private tags
+        fnames = self._index().get_level_values(0)
+        positions = info.index.get_indexer(fnames)
+        for key in ['duration', 'n_channels', 'sample_rate', 'size']:
+            self._tags[key] = info[key].values[positions]
+
+        # Check that the files match the properties of the dataset
+        for key in ['sample_rate', 'n_channels', 'bit_depth']:
+            expected = getattr(self.dataset, key, None)
+            n_invalid = (info[key] != expected).sum()
+            if expected is not None and n_invalid > 0:
+                warnings.warn(f'{n_invalid} audio files have a {key} '
+                              f'different from {expected}', RuntimeWarning)
+
+        return info
+
+    @instrument()
+    def segment(self, duration, hop=None, name=None):
+        # Split each audio file into segments of a fixed duration
+        #
+        # The returned subset has one row for each segment, with a
+        # (file name, segment) MultiIndex and `start` and `end` private
+        # tags (in seconds). Segments are `hop` seconds apart (default:
+        # `duration`), and the last segment of a file may extend past
+        # the end of the file, so that every file has at least one
+        # segment. Clip-level targets of the subset are repeated for
+        # each segment. For frame-level tags (multiple rows per file),
+        # only the tags that are constant within each file are kept,
+        # and the original tags are kept as `frame_tags`, so that the
+        # dataset can compute the frame-level targets of the segments.
+        if hop is None:
+            hop = duration
+
+        durations = self._durations()
+        n_segments = np.ceil((durations - duration) / hop - 1e-9) + 1
+        n_segments = np.maximum(n_segments, 1).astype(np.int64)
+
+        index = self._index()
+        fnames = index.get_level_values(0)
+        first = np.flatnonzero(~fnames.duplicated())
+        tags, private_tags = self._frames
+        frame_tags = None
+        if index.nlevels > 1:
+            # The tags are copied, as they may be modified in place
+            frame_tags = tags.copy()
+            nunique = tags.groupby(level=0, sort=False).nunique(dropna=False)
+            tags = tags.loc[:, (nunique <= 1).all().values]
+
+        # Repeat the (first) row of each file for each of its segments
+        positions = np.repeat(first, n_segments)
+        offsets = np.cumsum(n_segments) - n_segments
+        segments = np.arange(len(positions)) - np.repeat(offsets, n_segments)
+        segment_index = pd.MultiIndex.from_arrays(
+            [fnames[positions], segments],
+            names=[fnames.name or 'fname', 'segment'])
+        tags = tags.take(positions).set_axis(segment_index)
+        private_tags = private_tags.take(positions).set_axis(segment_index)
+        private_tags['start'] = segments * hop
+        private_tags['end'] = segments * hop + duration
+
+        return self.__class__._view(name or self.name, self.dataset,
+                                    (tags, private_tags),
+                                    audio_store=self.audio_store,
+                                    frame_tags=frame_tags)
+
+    def _durations(self):
+        # Return the duration of each audio file in seconds
+        private_tags = self._tags
+        if 'duration' not in private_tags:
+            clip_duration = getattr(self.dataset, 'clip_duration', None)
+            if clip_duration is not None:
+                n_files = len(self._index().unique(level=0))
+                return np.full(n_files, float(clip_duration))
+            # Probed durations are cached if a cache directory is set
+            self.probe()
+            private_tags = self._tags
+
+        fnames = self._index().get_level_values(0)
+        return private_tags['duration'].values[~fnames.duplicated()]
+
+    def load_audio(self, batch_size=32, n_workers=None, processes=False,
+                   prefetch=None, drop_last=False):
+        # Return an AudioLoader for the audio clips of this subset
+        #
+        # If the subset has `start` and `end` private tags (in seconds),
+        # there is one clip for each row. Otherwise, there is one clip
+        # for each audio file.
+        private_tags = self._tags
+        dataset = self.dataset
+        clip_duration = getattr(dataset, 'clip_duration', None)
+        starts = ends = None
+        if self.audio_store is None:
+            paths = self.audio_path_array
+        else:
+            fnames = self._index().unique(level=0)
+            paths = self.audio_store.positions(fnames)
+        if 'start' in private_tags:
+            codes, _ = pd.factorize(self._index().get_level_values(0))
+            paths = paths[codes]
+            starts = private_tags['start'].values
+            ends = private_tags['end'].values
+            clip_duration = (ends - starts).max(initial=0)
+
+        return AudioLoader(paths, starts, ends,
+                           sample_rate=getattr(dataset, 'sample_rate', None),
+                           clip_duration=clip_duration,
+                           n_channels=getattr(dataset, 'n_channels', None),
+                           batch_size=batch_size,
+                           n_workers=n_workers,
+                           processes=processes,
+                           prefetch=prefetch,
+                           drop_last=drop_last,
+                           store=self.audio_store,
+                           )
+
+    @instrument()
+    def features(self, extractor=None, cache_dir=None, **kwargs):
+        # Return a FeatureCache with the features of this subset
+        # See FeatureCache.update for the keyword arguments
+        return extract_features(self, extractor, cache_dir, **kwargs)
+
+    @instrument()
+    def pack(self, path, n_workers=None, processes=False):
+        # Pack the audio of this subset into a PackedAudio store, which
+        # is then used to load the audio of this subset and its subsets
+        self.audio_store = PackedAudio.create(self, path, n_workers,
+                                              processes)
+        return self.audio_store
+
+    @instrument()
+    def share(self, path=None, target=True, **kwargs):
+        return SharedSubset.create(self, path, target, **kwargs)
+
+    @instrument()
+    def save(self, path, target=True, **kwargs):
+        # Save the subset to a directory, from which it can be loaded
+        # without reading the metadata files of the dataset again
+        #
+        # The tags are pickled along with a copy of the dataset without
+        # its subsets. If `target` is true, the targets (computed using
+        # `kwargs`) are saved as .npy files that can be memory-mapped.
+        from jaffadata import __version__
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        tags, private_tags = self._frames
+        write_pickle(tags, path / 'tags.pkl')
+        write_pickle(private_tags, path / 'private_tags.pkl')
+        write_pickle(_detach(self.dataset), path / 'dataset.pkl')
+        if self.frame_tags is not None:
+            write_pickle(self.frame_tags, path / 'frame_tags.pkl')
+
+        meta = {'name': self.name, 'version': __version__}
+        if target:
+            key, (store, keys) = self._target_store(kwargs)
+            write_pickle(keys, path / 'target_keys.pkl')
+            meta['target'] = {
+                'key': key,
+                'type': type(store).__name__,
+                'args': store.save(path / 'targets'),
+            }
+        if isinstance(self.audio_store, PackedAudio):
+            meta['audio_store'] = str(self.audio_store.path)
+        with open(path / 'meta.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    @instrument()
+    def load(cls, path, dataset=None, mmap=False):
+        # Load a subset saved using DataSubset.save
+        #
+        # If `dataset` is None, the saved copy of the dataset is used.
+        # If `mmap` is true, the targets are memory-mapped.
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+        if dataset is None:
+            dataset = pd.read_pickle(path / 'dataset.pkl')
+
+        tags = pd.read_pickle(path / 'tags.pkl')
+        private_tags = pd.read_pickle(path / 'private_tags.pkl')
+        subset = cls._view(meta['name'], dataset, (tags, private_tags))
+        if (path / 'frame_tags.pkl').is_file():
+            subset.frame_tags = pd.read_pickle(path / 'frame_tags.pkl')
+
+        if 'target' in meta:
+            target_meta = meta['target']
+            store = load_targets(path / 'targets', target_meta['type'],
+                                 target_meta['args'], 'r' if mmap else None)
+            keys = pd.read_pickle(path / 'target_keys.pkl')
+            subset._target_stores[target_meta['key']] = store, keys
+        if 'audio_store' in meta:
+            subset.audio_store = PackedAudio(meta['audio_store'])
+        return subset
 
     @staticmethod
+    @instrument()
     def concat(subsets, name=None):
         # Check that subsets are from the same dataset
         ref = subsets[0]
         if any(ref.dataset != subset.dataset for subset in subsets[1:]):
             warnings.warn('Subset datasets do not match', RuntimeWarning)
 
-        tags = pd.concat([subset.tags for subset in subsets])
-        private_tags = pd.concat([subset._tags for subset in subsets])
         clazz = ref.__class__  # Constructor for creating subset
-        subset = clazz(name or ref.name, ref.dataset, (tags, private_tags))
-        return subset
-
-    def _subset(self, name, callback):
+        name = name or ref.name
+
+        # Keep the audio store only if it is shared by all subsets
+        audio_store = ref.audio_store
+        if any(subset.audio_store is not audio_store for subset in subsets):
+            audio_store = None
+
+        # Combine the frame-level tags of segmented subsets
+        frame_tags = [subset.frame_tags for subset in subsets]
+        if any(tags is None for tags in frame_tags):
+            frame_tags = None
+        elif all(tags is frame_tags[0] for tags in frame_tags):
+            frame_tags = frame_tags[0]
+        else:
+            frame_tags = pd.concat(list({id(tags): tags
+                                         for tags in frame_tags}.values()))
+
+        frames = [subset._frames for subset in subsets]
+        tags = pd.concat([frame[0] for frame in frames])
+        private_tags = pd.concat([frame[1] for frame in frames])
+        # Combine the categories of the audio directories, as
+        # concatenating categoricals would otherwise give strings
+        private_tags['audio_dir'] = union_categoricals(
+            [frame[1].audio_dir for frame in frames])
+        return clazz._view(name, ref.dataset, (tags, private_tags),
+                           audio_store=audio_store, frame_tags=frame_tags)
+
+    def _subset(self, name, positions):
         if name is None:
             # Default to name of parent
             name = self.name
 
-        tags = (callback(self.tags), callback(self._tags))
-        return self.__class__(name, self.dataset, tags)
+        # Only the selected rows are copied, so the subset does not
+        # refer to the tags of this subset, which may be modified
+        return self.__class__._view(name, self.dataset,
+                                    _take(self._frames, positions),
+                                    self.audio_store, self.frame_tags)
+
+    def _index(self):
+        return self.tags.index
+
+
+def _detach(dataset):
+    # Return a shallow copy of a dataset without its subsets
+    # Accessing the label set first ensures it is not computed lazily
+    # from the subsets of the copy
+    dataset.label_set
+    copy = dataset.__class__.__new__(dataset.__class__)
+    copy.__dict__.update(dataset.__dict__)
+    copy.subsets = {}
+    return copy
+
+
+@instrument('dataset.DataSubset.take')
+def _take(frames, positions):
+    # Copy the rows of the tags at the given positions
+    return tuple(frame.take(positions) for frame in frames)
 
 
 class _Indexer:
@@ -0,0 +1,194 @@
+import functools
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .audio import load
+from .cache import get_cache_dir, write_pickle
+from .parallel import imap
+
+
+class Spectrogram:
+    # Log power spectrogram computed with a short-time Fourier transform
+    #
+    # Calling an instance with an array of shape (..., n_samples)
+    # returns an array of shape (..., n_frames, n_features). Frames are
+    # centered, so n_frames = 1 + n_samples // hop_length.
+    def __init__(self, sample_rate, n_fft=1024, hop_length=512,
+                 log_offset=1e-8):
+        if sample_rate is None:
+            raise ValueError('A sample rate must be given')
+
+        self.sample_rate = sample_rate
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.log_offset = log_offset
+
+    @property
+    def config(self):
+        return {'name': type(self).__name__,
+                **{key: value for key, value in vars(self).items()
+                   if not key.startswith('_')}}
+
+    @property
+    def key(self):
+        # Return a key that identifies the configuration
+        config = json.dumps(self.config, sort_keys=True)
+        return hashlib.sha1(config.encode()).hexdigest()[:16]
+
+    @functools.cached_property
+    def _window(self):
+        return np.hanning(self.n_fft + 1)[:-1].astype(np.float32)
+
+    def power(self, x):
+        padding = [(0, 0)] * (x.ndim - 1) + [(self.n_fft // 2,) * 2]
+        x = np.pad(x, padding)
+        frames = np.lib.stride_tricks.sliding_window_view(
+            x, self.n_fft, axis=-1)[..., ::self.hop_length, :]
+        spec = np.fft.rfft(frames * self._window, axis=-1)
+        return spec.real ** 2 + spec.imag ** 2
+
+    def __call__(self, x):
+        x = self.power(x)
+        return np.log(x + self.log_offset).astype(np.float32)
+
+
+class LogMel(Spectrogram):
+    # Log-scaled mel spectrogram
+    def __init__(self, sample_rate, n_fft=1024, hop_length=512, n_mels=64,
+                 f_min=0, f_max=None, log_offset=1e-8):
+        super().__init__(sample_rate, n_fft, hop_length, log_offset)
+
+        self.n_mels = n_mels
+        self.f_min = f_min
+        self.f_max = f_max
+
+    @functools.cached_property
+    def _filterbank(self):
+        # Triangular filters equally spaced on the (HTK) mel scale
+        f_max = self.f_max or self.sample_rate / 2
+        mels = np.linspace(_mel(self.f_min), _mel(f_max), self.n_mels + 2)
+        hz = 700 * (10 ** (mels / 2595) - 1)
+        freqs = np.fft.rfftfreq(self.n_fft, 1 / self.sample_rate)
+        lower = (freqs - hz[:-2, None]) / (hz[1:-1] - hz[:-2])[:, None]
+        upper = (hz[2:, None] - freqs) / (hz[2:] - hz[1:-1])[:, None]
+        return np.maximum(0, np.minimum(lower, upper)).T.astype(np.float32)
+
+    def __call__(self, x):
+        x = self.power(x) @ self._filterbank
+        return np.log(x + self.log_offset).astype(np.float32)
+
+
+class FeatureCache:
+    # On-disk cache of the features of audio files
+    #
+    # Features are stored for each audio path in chunks (.npy files),
+    # which are memory-mapped when read. The cache directory is specific
+    # to the feature configuration, and features are only computed for
+    # audio files that are not yet in the cache. Each chunk stores the
+    # features of many files contiguously, with shape (n_frames,
+    # n_channels, n_features), and an index records the location of the
+    # features of each file.
+    def __init__(self, path, extractor):
+        self.path = Path(path) / extractor.key
+        self.extractor = extractor
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / 'config.json', 'w') as f:
+            json.dump(extractor.config, f, indent=2)
+
+        index_path = self.path / 'index.pkl'
+        if index_path.is_file():
+            self.index = pd.read_pickle(index_path)
+        else:
+            self.index = pd.DataFrame(
+                {'chunk': [], 'offset': [], 'n_frames': []},
+                index=pd.Index([], dtype=object), dtype=np.int64)
+        self._chunks = {}
+
+    def update(self, paths, n_channels=None, batch_size=32,
+               chunk_size=4096, n_workers=None, processes=False):
+        # Compute the features of the audio files that are not cached
+        paths = pd.Index(map(str, paths)).unique()
+        paths = paths[~paths.isin(self.index.index)]
+        if len(paths) == 0:
+            return self
+
+        extract = functools.partial(_extract,
+                                    extractor=self.extractor,
+                                    n_channels=n_channels)
+        batches = [paths[i:i + batch_size]
+                   for i in range(0, len(paths), batch_size)]
+        results = imap(extract, batches, n_workers, processes)
+
+        pending = []
+        for batch in results:
+            pending.extend(batch)
+            if len(pending) >= chunk_size:
+                self._write_chunk(paths, pending)
+                paths = paths[len(pending):]
+                pending = []
+        if pending:
+            self._write_chunk(paths, pending)
+        return self
+
+    def _write_chunk(self, paths, features):
+        chunk = int(self.index.chunk.max()) + 1 if len(self.index) else 0
+        n_frames = np.array([x.shape[1] for x in features])
+        data = np.concatenate([x.transpose(1, 0, 2) for x in features])
+        np.save(self.path / f'chunk-{chunk:05d}.npy', data)
+
+        offsets = np.cumsum(n_frames) - n_frames
+        index = pd.DataFrame({'chunk': chunk, 'offset': offsets,
+                              'n_frames': n_frames},
+                             index=paths[:len(features)])
+        self.index = pd.concat([self.index, index])
+        write_pickle(self.index, self.path / 'index.pkl')
+
+    def _chunk(self, chunk):
+        data = self._chunks.get(chunk)
+        if data is None:
+            data = np.load(self.path / f'chunk-{chunk:05d}.npy',
+                           mmap_mode='r')
+            self._chunks[chunk] = data
+        return data
+
+    def __getitem__(self, path):
+        # Return the features of an audio file with shape (n_channels,
+        # n_frames, n_features) without copying
+        chunk, offset, n_frames = self.index.loc[str(path)]
+        data = self._chunk(chunk)[offset:offset + n_frames]
+        return data.transpose(1, 0, 2)
+
+    def __contains__(self, path):
+        return str(path) in self.index.index
+
+    def __len__(self):
+        return len(self.index)
+
+
+def extract_features(subset, extractor=None, cache_dir=None, **kwargs):
+    # Return a FeatureCache containing the features of a subset
+    # The features are computed for any audio files that are not cached
+    dataset = subset.dataset
+    if extractor is None:
+        extractor = LogMel(getattr(dataset, 'sample_rate', None))
+    if cache_dir is None:
+        if get_cache_dir() is None:
+            raise ValueError('A cache directory has not been set')
+        cache_dir = get_cache_dir() / 'features'
+
+    cache = FeatureCache(cache_dir, extractor)
+    kwargs.setdefault('n_channels', getattr(dataset, 'n_channels', None))
+    return cache.update(subset.audio_path_array, **kwargs)
+
+
+def _extract(paths, extractor, n_channels):
+    return [extractor(load(path, extractor.sample_rate, n_channels=n_channels))
+            for path in paths]
+
+
+def _mel(hz):
+    return 2595 * np.log10(1 + hz / 700)
@@ -1,13 +1,15 @@
+import numpy as np
 import pandas as pd
 
+from .multilabel import MultiLabelArray
+from .profiling import instrument
 
-def binarize(subset, tag_name, index=None, is_label=True):
+
+@instrument()
+def binarize(subset, tag_name, index=None, is_label=True,
+             fmt='frame', dtype=None):
     if index is None:
-        fnames = subset.tags.index
-        y = pd.concat([binarize(subset, tag_name, fname, is_label)
-                       for fname in fnames],
-                      axis=1, keys=fnames).T
-        return y
+        return _binarize_all(subset, tag_name, is_label, fmt, dtype)
 
     labels = subset.tags[tag_name].loc[index]
     if not isinstance(labels, list):
@@ -18,3 +20,177 @@ def binarize(subset, tag_name, index=None, is_label=True):
     y = pd.Series(label_set, index=y_index, name=index)
     y = y.isin(labels).astype(float)
     return y
+
+
+def label_codes(subset, tag_name, is_label=True):
+    # Return (row position, label code) pairs, where a label code is
+    # the position of the label in the label set of the dataset
+    label_set = subset.dataset.label_set
+    if not is_label:
+        label_set = range(len(label_set))
+    return encode(subset.tags[tag_name].array, label_set)
+
+
+def encode(values, label_set):
+    # Return (row position, label code) pairs for an array of single
+    # labels or label lists, where codes are positions in `label_set`
+    label_set = pd.Index(label_set)
+    if isinstance(values, MultiLabelArray):
+        # Map the categories of the array to the label set instead of
+        # mapping every label individually
+        mapping = label_set.get_indexer(values.categories)
+        codes = mapping[values.codes]
+        rows = values.rows()
+    else:
+        values = pd.Series(values)
+        if values.dtype == object:
+            # Multi-label tags are stored as lists of labels
+            values = values.explode()
+        codes = label_set.get_indexer(values.values)
+        rows = values.index.values
+
+    # Ignore missing labels and labels not in the label set
+    valid = codes >= 0
+    return rows[valid], codes[valid]
+
+
+def to_matrix(rows, codes, shape, fmt='frame', dtype=None,
+              index=None, columns=None):
+    # Create a binary matrix from (row position, label code) pairs
+    #
+    # The 'store' format is a SparseTargets instance, which supports
+    # gathering the targets of a batch of rows and does not need SciPy.
+    if fmt == 'store':
+        return SparseTargets.from_codes(rows, codes, shape, dtype)
+    if fmt == 'sparse':
+        import scipy.sparse as sp
+
+        data = np.ones(len(rows), dtype=dtype or np.uint8)
+        y = sp.csr_matrix((data, (rows, codes)), shape=shape)
+        # Duplicate labels are summed, so reset them to one
+        y.data[:] = 1
+        return y
+
+    if fmt not in ['frame', 'array']:
+        raise ValueError(f'Invalid format: {fmt}')
+
+    if dtype is None:
+        dtype = float if fmt == 'frame' else np.uint8
+    y = np.zeros(shape, dtype=dtype)
+    y[rows, codes] = 1
+
+    if fmt == 'array':
+        return y
+    return pd.DataFrame(y, index=index, columns=columns)
+
+
+class SparseTargets:
+    # Binary targets stored in CSR form (row offsets and label codes)
+    #
+    # The targets of a batch of rows are gathered into a dense array
+    # with a few vectorized operations, so the full dense matrix never
+    # has to be created.
+    def __init__(self, offsets, codes, values, shape):
+        self.offsets = offsets
+        self.codes = codes
+        self.values = values
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_codes(cls, rows, codes, shape, dtype=None):
+        # Create a store from (row position, label code) pairs
+        # Duplicate pairs are removed and the pairs are sorted by row
+        keys = np.unique(np.asarray(rows, dtype=np.int64) * shape[1] + codes)
+        rows, codes = np.divmod(keys, shape[1])
+        offsets = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=shape[0]), out=offsets[1:])
+        values = np.ones(len(codes), dtype=dtype or np.uint8)
+        return cls(offsets, codes.astype(np.int32), values, shape)
+
+    def __getitem__(self, positions):
+        if np.ndim(positions) == 0:
+            return self[[positions]][0]
+
+        positions = np.asarray(positions)
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        # Concatenate the ranges [start, start + length)
+        offsets = np.cumsum(lengths) - lengths
+        entries = (np.repeat(starts - offsets, lengths)
+                   + np.arange(lengths.sum()))
+
+        y = np.zeros((len(positions), self.shape[1]), dtype=self.values.dtype)
+        rows = np.repeat(np.arange(len(positions)), lengths)
+        y[rows, self.codes[entries]] = self.values[entries]
+        return y
+
+    def __len__(self):
+        return self.shape[0]
+
+    def save(self, path):
+        # Save the arrays and return the arguments for loading them
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ['offsets', 'codes', 'values']:
+            np.save(path / f'{name}.npy', getattr(self, name))
+        return {'shape': list(self.shape)}
+
+    @classmethod
+    def load(cls, path, shape, mmap_mode=None):
+        return cls(*[np.load(path / f'{name}.npy', mmap_mode)
+                     for name in ['offsets', 'codes', 'values']], shape)
+
+
+class DenseTargets:
+    # Targets stored as one or more arrays (e.g. frame-level targets)
+    # with the same first dimension
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __getitem__(self, positions):
+        if isinstance(self.arrays, tuple):
+            return tuple(arr if arr is None else arr[positions]
+                         for arr in self.arrays)
+        return self.arrays[positions]
+
+    def __len__(self):
+        if isinstance(self.arrays, tuple):
+            return len(self.arrays[0])
+        return len(self.arrays)
+
+    def save(self, path):
+        # Save the arrays and return the arguments for loading them
+        path.mkdir(parents=True, exist_ok=True)
+        if not isinstance(self.arrays, tuple):
+            np.save(path / '0.npy', self.arrays)
+            return {'n_arrays': None}
+
+        for i, arr in enumerate(self.arrays):
+            if arr is not None:
+                np.save(path / f'{i}.npy', arr)
+        return {'n_arrays': len(self.arrays)}
+
+    @classmethod
+    def load(cls, path, n_arrays=None, mmap_mode=None):
+        def _load(i):
+            if not (path / f'{i}.npy').is_file():
+                return None
+            return np.load(path / f'{i}.npy', mmap_mode)
+
+        if n_arrays is None:
+            return cls(_load(0))
+        return cls(tuple(_load(i) for i in range(n_arrays)))
+
+
+def load_targets(path, store_type, args, mmap_mode=None):
+    # Load targets saved using SparseTargets.save or DenseTargets.save
+    store_cls = {'SparseTargets': SparseTargets,
+                 'DenseTargets': DenseTargets}[store_type]
+    return store_cls.load(path, mmap_mode=mmap_mode, **args)
+
+
+def _binarize_all(subset, tag_name, is_label, fmt, dtype):
+    label_set = subset.dataset.label_set
+    shape = (len(subset.tags), len(label_set))
+    rows, codes = label_codes(subset, tag_name, is_label)
+    return to_matrix(rows, codes, shape, fmt, dtype,
+                     subset.tags.index, label_set)
@@ -1,40 +1,269 @@
+import functools
 import operator
 import re
 
+import numpy as np
+import pandas as pd
 import pandas.api.types as types
 
+from .multilabel import MultiLabelArray
+
 
 class FrameMask:
+    # Boolean mask for a DataFrame defined by a specification string
+    #
+    # A specification is a list of conditions separated by ',' (and)
+    # or '|' (or), where ',' binds more tightly than '|'. Conditions can
+    # be negated with '~' or '!' and grouped with parentheses. Examples:
+    #
+    #   fold=1, esc10=True
+    #   fold in 1..3 | ~(usage='Public')
+    #   category in ['dog', 'rooster']
+    #   labels has 'Bark'
+    #
+    # Unquoted values may contain balanced parentheses and brackets
+    # (e.g. name=Dog (bark)), but values containing ',' or '|' must be
+    # quoted, as these characters separate conditions.
+    #
+    # Specifications are compiled once, so creating the same FrameMask
+    # again does not require the string to be parsed again.
     def __init__(self, specs):
-        self.specs = [FrameMask._parse(spec) for spec in specs.split(',')]
-
-    def value(self, df):
-        mask = True
-        for key, value, op in self.specs:
-            # Convert the value to the appropriate type
-            if types.is_integer_dtype(df.dtypes[key]):
-                value = int(value)
-            elif types.is_numeric_dtype(df.dtypes[key]):
-                value = float(value)
-
-            mask &= op(df[key], value)
-        return mask
-
-    def _parse(spec):
-        ops = {
-            '<': operator.lt,
-            '<=': operator.le,
-            '=': operator.eq,
-            '==': operator.eq,
-            '!=': operator.ne,
-            '>=': operator.ge,
-            '>': operator.gt,
-        }
-
-        pattern = r'(\w+)\s*([!=<>]+)\s*(["\']?)([^"\'!=<>]+|-)?\3$'
-        match = re.match(pattern, spec.strip())
-        if match is None or ops.get(match[2]) is None:
-            raise ValueError(f'Invalid mask specification: {spec}')
-
-        # Return (key, value, operator)
-        return match[1], match[4] or '', ops[match[2]]
+        self.specs = specs
+        self.expr = _compile(specs)
+
+    def value(self, df):
+        return self.expr.value(df)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(specs):
+    parser = _Parser(specs)
+    expr = parser.parse_or()
+    if not parser.at_end():
+        parser.error()
+    return expr
+
+
+class _Parser:
+    ops = {
+        '<': operator.lt,
+        '<=': operator.le,
+        '=': operator.eq,
+        '==': operator.eq,
+        '!=': operator.ne,
+        '>=': operator.ge,
+        '>': operator.gt,
+    }
+
+    key_pattern = re.compile(r'\s*(\w+)\s*')
+    op_pattern = re.compile(r'(<=|>=|==|!=|=|<|>|in\b|has\b)\s*')
+    quoted_pattern = re.compile(r'\s*(["\'])(.*?)\1\s*')
+    # Characters of unquoted values, with one level of nested brackets
+    bare_char = r'[^"\'!=<>,|()\[\]]'
+    bare_pattern = re.compile(rf'((?:{bare_char}|\({bare_char}*\)'
+                              rf'|\[{bare_char}*\])*)')
+
+    def __init__(self, specs):
+        self.specs = specs
+        self.pos = 0
+
+    def parse_or(self):
+        exprs = [self.parse_and()]
+        while self.accept('|'):
+            exprs.append(self.parse_and())
+        return exprs[0] if len(exprs) == 1 else _Or(exprs)
+
+    def parse_and(self):
+        exprs = [self.parse_unary()]
+        while self.accept(','):
+            exprs.append(self.parse_unary())
+        return exprs[0] if len(exprs) == 1 else _And(exprs)
+
+    def parse_unary(self):
+        if self.accept('~') or self.accept('!'):
+            return _Not(self.parse_unary())
+        if self.accept('('):
+            expr = self.parse_or()
+            if not self.accept(')'):
+                self.error()
+            return expr
+        return self.parse_condition()
+
+    def parse_condition(self):
+        key = self.match(self.key_pattern)[1]
+        match = self.op_pattern.match(self.specs, self.pos)
+        if match is None:
+            # A key on its own selects rows where the tag is true
+            return _Truth(key)
+
+        self.pos = match.end()
+        op = match[1]
+        if op == 'has':
+            return _Has(key, self.parse_values())
+        if op == 'in':
+            values = self.parse_values()
+            if isinstance(values, tuple):
+                return _Range(key, *values)
+            return _In(key, values)
+        return _Compare(key, self.ops[op], self.parse_value())
+
+    def parse_values(self):
+        # Parse a list of values, a range of values, or a single value
+        if self.accept('['):
+            values = [self.parse_value()]
+            while self.accept(','):
+                values.append(self.parse_value())
+            if not self.accept(']'):
+                self.error()
+            return values
+
+        value = self.parse_value()
+        if self.accept('..'):
+            return value, self.parse_value()
+        return [value]
+
+    def parse_value(self):
+        match = self.quoted_pattern.match(self.specs, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            return match[2]
+
+        match = self.match(self.bare_pattern)
+        value = match[1]
+        if '..' in value:
+            # Leave the range operator for the caller to consume
+            value = value[:value.index('..')]
+            self.pos = match.start() + len(value)
+        return value.strip()
+
+    def accept(self, token):
+        pos = self.pos
+        while pos < len(self.specs) and self.specs[pos].isspace():
+            pos += 1
+        if not self.specs.startswith(token, pos):
+            return False
+        if token in '~!' and self.specs.startswith('!=', pos):
+            return False
+        self.pos = pos + len(token)
+        return True
+
+    def match(self, pattern):
+        match = pattern.match(self.specs, self.pos)
+        if match is None:
+            self.error()
+        self.pos = match.end()
+        return match
+
+    def at_end(self):
+        return self.specs[self.pos:].strip() == ''
+
+    def error(self):
+        raise ValueError(f'Invalid mask specification: {self.specs}')
+
+
+class _Condition:
+    def __init__(self, key):
+        self.key = key
+        self._converted = {}
+
+    def convert(self, df, values):
+        # Convert string values to the type of the column
+        # Conversions are cached for each column dtype
+        dtype = df.dtypes[self.key]
+        converted = self._converted.get(dtype)
+        if converted is None:
+            converted = [_convert(value, dtype) for value in values]
+            self._converted[dtype] = converted
+        return converted
+
+
+class _Compare(_Condition):
+    def __init__(self, key, op, value):
+        super().__init__(key)
+        self.op = op
+        self.values = [value]
+
+    def value(self, df):
+        value, = self.convert(df, self.values)
+        return self.op(df[self.key], value)
+
+
+class _In(_Condition):
+    def __init__(self, key, values):
+        super().__init__(key)
+        self.values = values
+
+    def value(self, df):
+        return df[self.key].isin(self.convert(df, self.values))
+
+
+class _Range(_Condition):
+    def __init__(self, key, low, high):
+        super().__init__(key)
+        self.values = [low, high]
+
+    def value(self, df):
+        low, high = self.convert(df, self.values)
+        column = df[self.key]
+        return (column >= low) & (column <= high)
+
+
+class _Has(_Condition):
+    def __init__(self, key, values):
+        super().__init__(key)
+        self.values = values
+
+    def value(self, df):
+        labels = df[self.key].array
+        if not isinstance(labels, MultiLabelArray):
+            values = set(self.values)
+            return df[self.key].map(lambda x: not values.isdisjoint(
+                x if isinstance(x, list) else [x]))
+
+        # Look up the codes of the labels rather than the labels
+        codes = labels.categories.get_indexer(self.values)
+        rows = labels.rows()[np.isin(labels.codes, codes[codes >= 0])]
+        mask = np.zeros(len(labels), dtype=bool)
+        mask[rows] = True
+        return pd.Series(mask, index=df.index)
+
+
+class _Truth(_Condition):
+    def value(self, df):
+        return df[self.key].astype(bool)
+
+
+class _Not:
+    def __init__(self, expr):
+        self.expr = expr
+
+    def value(self, df):
+        return ~self.expr.value(df)
+
+
+class _And:
+    def __init__(self, exprs):
+        self.exprs = exprs
+
+    def value(self, df):
+        return functools.reduce(operator.and_,
+                                [expr.value(df) for expr in self.exprs])
+
+
+class _Or:
+    def __init__(self, exprs):
+        self.exprs = exprs
+
+    def value(self, df):
+        return functools.reduce(operator.or_,
+                                [expr.value(df) for expr in self.exprs])
+
+
+def _convert(value, dtype):
+    if types.is_bool_dtype(dtype):
+        return value.lower() in ['true', '1']
+    if types.is_integer_dtype(dtype):
+        return int(value)
+    if types.is_numeric_dtype(dtype):
+        return float(value)
+    return value
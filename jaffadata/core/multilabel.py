@@ -0,0 +1,331 @@
+import numbers
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import (
+    ExtensionArray,
+    ExtensionDtype,
+    register_extension_dtype,
+)
+from pandas.api.indexers import check_array_indexer
+from pandas.api.types import pandas_dtype
+
+
+@register_extension_dtype
+class MultiLabelDtype(ExtensionDtype):
+    name = 'multilabel'
+    # The scalar type is reported as object so that pandas treats the
+    # label lists like an object column where it matters (e.g. explode)
+    type = np.object_
+    kind = 'O'
+    na_value = np.nan
+
+    def __init__(self, categories=None):
+        if categories is None:
+            categories = []
+        self.categories = pd.Index(categories)
+
+    @classmethod
+    def construct_array_type(cls):
+        return MultiLabelArray
+
+    def _get_common_dtype(self, dtypes):
+        if not all(isinstance(dtype, MultiLabelDtype) for dtype in dtypes):
+            return None
+
+        categories = dtypes[0].categories
+        for dtype in dtypes[1:]:
+            categories = categories.union(dtype.categories)
+        return MultiLabelDtype(categories)
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return other == self.name
+        return (isinstance(other, MultiLabelDtype)
+                and self.categories.equals(other.categories))
+
+    def __hash__(self):
+        return hash((self.name, tuple(self.categories)))
+
+
+class MultiLabelArray(ExtensionArray):
+    # Array of label lists stored in compressed sparse row (CSR) format
+    #
+    # The labels of row i are categories[codes[offsets[i]:offsets[i+1]]],
+    # so only one integer is stored per label rather than one Python
+    # list of strings per row. Missing rows (e.g. from reindexing) are
+    # recorded in a boolean mask and have no labels.
+    def __init__(self, offsets, codes, categories, mask=None):
+        categories = pd.Index(categories)
+        code_dtype = np.int16 if len(categories) < 2 ** 15 else np.int32
+
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._codes = np.asarray(codes, dtype=code_dtype)
+        self._dtype = MultiLabelDtype(categories)
+        if mask is None:
+            mask = np.zeros(len(self._offsets) - 1, dtype=bool)
+        self._mask = np.asarray(mask, dtype=bool)
+
+    @classmethod
+    def from_lists(cls, values, categories=None):
+        # Each value is a list of labels or a missing value
+        values = pd.Series(list(values), dtype=object)
+        return cls._from_exploded(values.explode(), values.isna().values,
+                                  categories)
+
+    @classmethod
+    def from_strings(cls, values, sep=',', categories=None):
+        # Each value is a string of labels separated by `sep`
+        values = pd.Series(np.asarray(values, dtype=object))
+        labels = values.str.split(sep).explode()
+        return cls._from_exploded(labels, values.isna().values, categories)
+
+    @classmethod
+    def _from_exploded(cls, labels, mask, categories):
+        # Labels are indexed by row position; missing values and labels
+        # that are not in `categories` are dropped
+        labels = labels[labels.notna()]
+        rows = labels.index.values.astype(np.int64)
+        labels = pd.Categorical(labels.values, categories=categories)
+        valid = labels.codes >= 0
+        counts = np.bincount(rows[valid], minlength=len(mask))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(offsets, labels.codes[valid], labels.categories, mask)
+
+    @classmethod
+    def _from_sequence(cls, scalars, dtype=None, copy=False):
+        if isinstance(scalars, MultiLabelArray):
+            return scalars.astype(dtype) if dtype is not None else scalars
+        # The categories are inferred unless they are given, as the
+        # dtype constructed from the name 'multilabel' has none
+        categories = None
+        if dtype is not None:
+            categories = pandas_dtype(dtype).categories
+        if categories is not None and len(categories) == 0:
+            categories = None
+        return cls.from_lists(list(scalars), categories)
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls.from_lists([list(value) for value in values],
+                              original.categories)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        dtype = to_concat[0].dtype._get_common_dtype(
+            [array.dtype for array in to_concat])
+        to_concat = [array.astype(dtype) for array in to_concat]
+
+        counts = [np.diff(array._offsets) for array in to_concat]
+        offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+        codes = np.concatenate([array._codes for array in to_concat])
+        mask = np.concatenate([array._mask for array in to_concat])
+        return cls(offsets, codes, dtype.categories, mask)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def categories(self):
+        return self._dtype.categories
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def codes(self):
+        return self._codes
+
+    @property
+    def nbytes(self):
+        return self._offsets.nbytes + self._codes.nbytes + self._mask.nbytes
+
+    def rows(self):
+        # Return the row position of each label code
+        return np.repeat(np.arange(len(self)), np.diff(self._offsets))
+
+    def unique_labels(self):
+        return self.categories[np.unique(self._codes)]
+
+    def map_categories(self, mapper):
+        # Relabel the categories, merging those that map to the same label
+        labels = pd.Categorical([mapper(label) for label in self.categories])
+        codes = labels.codes[self._codes]
+        return MultiLabelArray(self._offsets, codes, labels.categories,
+                               self._mask)
+
+    def __getitem__(self, item):
+        if isinstance(item, numbers.Integral):
+            if item < 0:
+                item += len(self)
+            if self._mask[item]:
+                return self.dtype.na_value
+            start, end = self._offsets[item], self._offsets[item + 1]
+            return list(self.categories[self._codes[start:end]])
+
+        item = check_array_indexer(self, item)
+        return self.take(np.arange(len(self))[item])
+
+    def __setitem__(self, key, value):
+        # `value` is a list of labels if `key` selects a single row and
+        # a sequence of label lists otherwise
+        key = check_array_indexer(self, key)
+        positions = np.arange(len(self))[key]
+        if np.ndim(positions) == 0 or _is_na(value):
+            value = [value] * np.size(positions)
+        if not isinstance(value, MultiLabelArray):
+            value = MultiLabelArray.from_lists(value, None)
+        positions = np.atleast_1d(positions)
+        if len(value) != len(positions):
+            raise ValueError(f'Cannot set {len(value)} values '
+                             f'for {len(positions)} rows')
+
+        # Rebuild the array with the new rows in place of the old ones
+        indices = np.arange(len(self))
+        indices[positions] = len(self) + np.arange(len(value))
+        array = self._concat_same_type([self, value]).take(indices)
+        self._offsets = array._offsets
+        self._codes = array._codes
+        self._dtype = array._dtype
+        self._mask = array._mask
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        categories = list(self.categories)
+        codes = self._codes.tolist()
+        offsets = self._offsets.tolist()
+        na_value = self.dtype.na_value
+        for start, end, missing in zip(offsets[:-1], offsets[1:],
+                                       self._mask.tolist()):
+            if missing:
+                yield na_value
+            else:
+                yield [categories[code] for code in codes[start:end]]
+
+    def __eq__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if isinstance(other, (MultiLabelArray, np.ndarray)):
+            # Compare element-wise, as is done for object arrays
+            if len(other) != len(self):
+                raise ValueError('Lengths must match to compare')
+            return np.array([isinstance(x, list) and x == y
+                             for x, y in zip(self, other)], dtype=bool)
+        return np.array([isinstance(x, list) and x == other
+                         for x in self], dtype=bool)
+
+    def __getattr__(self, name):
+        # The methods of Series.str (e.g. str.join) are applied to the
+        # label lists as they are for a column of lists
+        if name.startswith('_str_'):
+            return getattr(pd.array(np.asarray(self), dtype=object), name)
+        raise AttributeError(name)
+
+    def __array__(self, dtype=None):
+        values = np.empty(len(self), dtype=object)
+        values[:] = list(self)
+        return values
+
+    def isna(self):
+        return self._mask.copy()
+
+    def value_counts(self, dropna=True):
+        # Count the occurrences of each label list
+        values = pd.Series(self._values_for_argsort())
+        counts = values.value_counts(dropna=dropna)
+        index = np.empty(len(counts), dtype=object)
+        index[:] = [list(x) if isinstance(x, tuple) else x
+                    for x in counts.index]
+        return pd.Series(counts.values, index=index, name=counts.name)
+
+    def unique(self):
+        values = pd.Series(self._values_for_argsort())
+        return self.take(np.flatnonzero(~values.duplicated().values))
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        indices = np.asarray(indices, dtype=np.int64)
+        if allow_fill:
+            if (indices < -1).any():
+                raise ValueError('Invalid value in `indices`')
+            if fill_value is not None and not _is_na(fill_value):
+                raise ValueError('Only missing values can be filled')
+            missing = indices == -1
+        else:
+            indices = np.where(indices < 0, indices + len(self), indices)
+            missing = np.zeros(len(indices), dtype=bool)
+
+        if ((indices >= len(self)) | (indices < -1)).any():
+            raise IndexError('Index out of bounds')
+
+        indices = np.where(missing, 0, indices)
+        starts = self._offsets[indices]
+        counts = np.where(missing, 0, self._offsets[indices + 1] - starts)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        # Gather the code ranges of the selected rows in one operation
+        row_starts = np.repeat(starts - offsets[:-1], counts)
+        codes = self._codes[np.arange(offsets[-1]) + row_starts]
+        mask = missing | self._mask[indices]
+        return MultiLabelArray(offsets, codes, self.categories, mask)
+
+    def copy(self):
+        return MultiLabelArray(self._offsets.copy(), self._codes.copy(),
+                               self.categories, self._mask.copy())
+
+    def astype(self, dtype, copy=True):
+        if isinstance(dtype, MultiLabelDtype):
+            if dtype == self.dtype:
+                return self.copy() if copy else self
+
+            # Remap codes to the positions of the new categories
+            mapping = dtype.categories.get_indexer(self.categories)
+            codes = mapping[self._codes]
+            if (codes < 0).any():
+                raise ValueError('Categories are missing from `dtype`')
+            return MultiLabelArray(self._offsets, codes, dtype.categories,
+                                   self._mask)
+
+        values = np.array(self)
+        dtype = pandas_dtype(dtype)
+        if dtype.kind in 'US':
+            # Convert the label lists to their string representations
+            values = np.array([str(x) for x in values], dtype=dtype)
+            return values
+        return values.astype(dtype, copy=False)
+
+    def _values_for_factorize(self):
+        return self._values_for_argsort(), np.nan
+
+    def _values_for_argsort(self):
+        # Tuples are hashable and are ordered like lists
+        values = np.empty(len(self), dtype=object)
+        values[:] = [tuple(labels) if isinstance(labels, list) else labels
+                     for labels in self]
+        return values
+
+    def _explode(self):
+        # Return the labels of each row and the number of labels, where
+        # rows without labels have a single missing value (as for lists)
+        counts = np.diff(self._offsets)
+        sizes = np.maximum(counts, 1)
+        starts = np.cumsum(sizes) - sizes
+        positions = (np.repeat(starts - self._offsets[:-1], counts)
+                     + np.arange(len(self._codes)))
+        values = np.full(sizes.sum(), np.nan, dtype=object)
+        values[positions] = np.asarray(self.categories,
+                                       dtype=object)[self._codes]
+        return values, sizes
+
+    def _reduce(self, name, skipna=True, **kwargs):
+        if name == 'sum':
+            # Concatenate the label lists as is done for lists
+            return list(self.categories[self._codes])
+        raise TypeError(f'Cannot perform reduction {name!r} on labels')
+
+
+def _is_na(value):
+    return not pd.api.types.is_list_like(value) and pd.isna(value)
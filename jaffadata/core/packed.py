@@ -0,0 +1,119 @@
+import functools
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .audio import load, probe, resample
+from .parallel import imap
+
+
+class PackedAudio:
+    # Audio of a DataSubset packed into a single int16 file
+    #
+    # The clips are stored contiguously as interleaved int16 samples,
+    # with an index of offsets (in frames) for the file names in the
+    # same order as the (unique) file names of the subset. Clips are
+    # read by slicing a memory-mapped array, which avoids opening a
+    # file for every clip. Like SharedSubset, pickling a PackedAudio
+    # instance only transfers the directory path.
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as f:
+            meta = json.load(f)
+        self.sample_rate = meta['sample_rate']
+        self.n_channels = meta['n_channels']
+        self.fnames = np.load(self.path / 'fnames.npy')
+        self.offsets = np.load(self.path / 'offsets.npy')
+
+        if self.offsets[-1] > 0:
+            self.data = np.memmap(self.path / 'audio.bin', dtype='<i2',
+                                  mode='r',
+                                  shape=(self.offsets[-1], self.n_channels))
+        else:
+            self.data = np.zeros((0, self.n_channels), dtype='<i2')
+
+    @classmethod
+    def create(cls, subset, path, n_workers=None, processes=False):
+        # Decode the audio of a subset and write it to `path`
+        #
+        # The audio is resampled to the sample rate of the dataset and
+        # downmixed if the dataset is mono.
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        audio_paths = subset.audio_path_array
+        fnames = subset._index().unique(level=0)
+        sample_rate = getattr(subset.dataset, 'sample_rate', None)
+        n_channels = getattr(subset.dataset, 'n_channels', None)
+        if sample_rate is None and len(audio_paths) > 0:
+            sample_rate = probe(audio_paths[0]).sample_rate
+
+        load_clip = functools.partial(load, sample_rate=sample_rate,
+                                      n_channels=n_channels)
+        offsets = np.zeros(len(audio_paths) + 1, dtype=np.int64)
+        tmp_path = path / f'audio.bin.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            clips = imap(load_clip, audio_paths, n_workers, processes)
+            for i, x in enumerate(clips):
+                if n_channels is None:
+                    n_channels = len(x)
+                elif len(x) != n_channels:
+                    raise ValueError(f'Expected {n_channels} channels: '
+                                     f'{audio_paths[i]}')
+
+                x = np.clip(np.round(x * 32768), -32768, 32767)
+                f.write(x.T.astype('<i2').tobytes())
+                offsets[i + 1] = offsets[i] + x.shape[1]
+        os.replace(tmp_path, path / 'audio.bin')
+
+        np.save(path / 'fnames.npy', np.asarray(fnames, dtype=str))
+        np.save(path / 'offsets.npy', offsets)
+        with open(path / 'meta.json', 'w') as f:
+            json.dump({'sample_rate': sample_rate,
+                       'n_channels': n_channels or 1}, f)
+
+        return cls(path)
+
+    def positions(self, fnames):
+        # Return the positions of the given file names in the store
+        positions = self._fname_index.get_indexer(fnames)
+        n_missing = (positions < 0).sum()
+        if n_missing > 0:
+            raise ValueError(f'{n_missing} files are not in {self.path}')
+        return positions
+
+    @functools.cached_property
+    def _fname_index(self):
+        return pd.Index(self.fnames)
+
+    def read(self, position, start=0, end=None):
+        # Return a view of the int16 samples of a clip with shape
+        # (n_channels, n_samples) without copying
+        first, last = self.offsets[position], self.offsets[position + 1]
+        stop = last
+        if end is not None:
+            stop = min(first + round(end * self.sample_rate), last)
+        first = min(first + round(start * self.sample_rate), last)
+        return self.data[first:max(stop, first)].T
+
+    def load(self, position, sample_rate=None, start=0, end=None,
+             n_channels=None):
+        # Same as audio.load but for a clip in the store
+        x = self.read(position, start, end) / np.float32(32768)
+        if n_channels == 1 and len(x) > 1:
+            x = x.mean(axis=0, keepdims=True)
+        if sample_rate is not None and sample_rate != self.sample_rate:
+            x = resample(x, self.sample_rate, sample_rate)
+        return x
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
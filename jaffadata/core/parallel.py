@@ -0,0 +1,27 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def imap(fn, items, n_workers=None, processes=False, prefetch=None):
+    # Lazily apply `fn` to each item using a pool of workers
+    #
+    # Results are yielded in the same order as `items`. At most
+    # `prefetch` items are processed ahead of the consumer, so memory
+    # usage does not grow with the number of items. If `n_workers` is
+    # None or 1, items are processed serially in the calling thread.
+    if n_workers is None or n_workers <= 1:
+        yield from map(fn, items)
+        return
+
+    if prefetch is None:
+        prefetch = 2 * n_workers
+
+    executor_cls = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_cls(n_workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) >= prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
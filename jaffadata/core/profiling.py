@@ -0,0 +1,140 @@
+import functools
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+
+_enabled = bool(os.environ.get('JAFFADATA_PROFILE'))
+_memory = False
+_records = []
+_callbacks = []
+_peaks = []
+
+
+def enable(memory=False):
+    # Start recording instrumented operations
+    #
+    # If `memory` is true, the peak memory usage of each operation is
+    # also recorded using tracemalloc, which slows down execution.
+    # This requires tracemalloc.reset_peak (Python 3.9 or later).
+    global _enabled, _memory
+    if memory and not hasattr(tracemalloc, 'reset_peak'):
+        raise RuntimeError('Memory profiling requires Python 3.9 or later')
+    _enabled = True
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+    _memory = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_callback(fn):
+    # Call `fn` with each record (a dict) as soon as it is recorded,
+    # e.g. to forward the measurements to a metrics system
+    _callbacks.append(fn)
+
+
+def remove_callback(fn):
+    _callbacks.remove(fn)
+
+
+def records():
+    return list(_records)
+
+
+def reset():
+    _records.clear()
+
+
+def report():
+    # Summarize the records for each operation as a DataFrame
+    columns = ['name', 'time', 'rows', 'peak_mb']
+    df = pd.DataFrame(_records, columns=columns)
+    return df.groupby('name', sort=False).agg(
+        count=('time', 'size'),
+        total_time=('time', 'sum'),
+        mean_time=('time', 'mean'),
+        max_time=('time', 'max'),
+        rows=('rows', 'sum'),
+        peak_mb=('peak_mb', 'max'),
+    ).sort_values('total_time', ascending=False)
+
+
+def instrument(name=None, rows=None):
+    # Decorator for recording the wall time, number of rows, and
+    # (optionally) peak memory usage of each call to a function
+    #
+    # The number of rows is determined from the return value, unless
+    # `rows` is given. This is a function that is called with the first
+    # argument after the call, e.g. for constructors, which return None.
+    # When profiling is disabled, the only overhead is checking a flag.
+    def decorator(fn):
+        op_name = name
+        if op_name is None:
+            module = fn.__module__.rsplit('.', 1)[-1]
+            op_name = f'{module}.{fn.__qualname__}'
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            return _record(op_name, fn, args, kwargs, rows)
+
+        return wrapper
+
+    return decorator
+
+
+def _record(name, fn, args, kwargs, rows=None):
+    memory = _memory and tracemalloc.is_tracing()
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        # Keep track of the peak of any enclosing operation, as
+        # resetting the peak here would otherwise lose it
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], peak)
+        _peaks.append(0)
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    try:
+        value = fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_mb = None
+        if memory:
+            peak = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+            peak_mb = (peak - current) / 2 ** 20
+
+    n_rows = _n_rows(value) if rows is None else rows(args[0])
+    record = {'name': name, 'time': elapsed, 'rows': n_rows,
+              'peak_mb': peak_mb}
+    _records.append(record)
+    for callback in _callbacks:
+        callback(record)
+    return value
+
+
+def _n_rows(value):
+    if isinstance(value, tuple) and len(value) > 0:
+        value = value[0]
+    shape = getattr(value, 'shape', None)
+    if shape:
+        return shape[0]
+    if hasattr(value, '__len__') and not isinstance(value, str):
+        return len(value)
+    return None
@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+
+from .labels import DenseTargets, SparseTargets
+
+
+class _Sampler:
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self, n):
+        raise NotImplementedError
+
+    def batches(self, batch_size):
+        # Generate batches of row positions indefinitely
+        while True:
+            yield self.sample(batch_size)
+
+    def __iter__(self):
+        for batch in self.batches(1024):
+            yield from batch.tolist()
+
+
+class WeightedSampler(_Sampler):
+    # Sample row positions with replacement in proportion to `weights`
+    #
+    # Walker's alias method is used, so each draw is O(1). The alias
+    # table is constructed without a Python loop by noting that, in
+    # Vose's algorithm, the large items absorb the deficits (1 - p) of
+    # the small items in order, so the pairing of small items with
+    # large items can be found by comparing cumulative sums.
+    def __init__(self, weights, seed=None):
+        super().__init__(seed)
+
+        weights = np.asarray(weights, dtype=float)
+        if (weights < 0).any() or weights.sum() <= 0:
+            raise ValueError('`weights` must be non-negative and not all 0')
+
+        n = len(weights)
+        prob = weights * n / weights.sum()
+        self.alias = np.arange(n)
+        self.prob = np.ones(n)
+
+        small = np.flatnonzero(prob < 1)
+        large = np.flatnonzero(prob >= 1)
+        if len(small) == 0 or len(large) == 0:
+            return
+
+        deficits = np.cumsum(1 - prob[small])
+        excesses = np.cumsum(prob[large] - 1)
+
+        # Each small item is paired with the large item whose excess
+        # covers the start of its deficit
+        pairing = np.searchsorted(excesses, deficits - (1 - prob[small]))
+        self.alias[small] = large[np.minimum(pairing, len(large) - 1)]
+        self.prob[small] = prob[small]
+
+        # A large item becomes small once its excess is used up, after
+        # which it is paired with the next large item
+        depleted = np.searchsorted(deficits, excesses[:-1], side='right')
+        turned = np.flatnonzero(depleted < len(small))
+        self.alias[large[turned]] = large[turned + 1]
+        self.prob[large[turned]] = \
+            1 + excesses[turned] - deficits[depleted[turned]]
+
+    def sample(self, n):
+        index = self.rng.integers(len(self.prob), size=n)
+        accept = self.rng.random(n) < self.prob[index]
+        return np.where(accept, index, self.alias[index])
+
+
+class BalancedSampler(_Sampler):
+    # Sample row positions such that each class is equally likely
+    #
+    # A class is chosen uniformly at random, and then a row that is
+    # labelled with that class is chosen uniformly at random. For
+    # multi-label data, this is the class-balanced sampling scheme
+    # typically used for AudioSet.
+    def __init__(self, y, seed=None):
+        super().__init__(seed)
+
+        offsets, codes = _to_csr(y)
+        n_classes = _n_classes(y)
+        rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+        # Group the rows by class
+        order = np.argsort(codes, kind='stable')
+        self.rows = rows[order]
+        counts = np.bincount(codes, minlength=n_classes)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.classes = np.flatnonzero(counts)
+
+    def sample(self, n):
+        classes = self.rng.choice(self.classes, size=n)
+        index = self.rng.integers(self.offsets[classes],
+                                  self.offsets[classes + 1])
+        return self.rows[index]
+
+
+def class_weights(y):
+    # Return the inverse frequency of each class (or 0 if absent)
+    _, codes = _to_csr(y)
+    counts = np.bincount(codes, minlength=_n_classes(y))
+    weights = np.zeros(len(counts))
+    weights[counts > 0] = 1 / counts[counts > 0]
+    return weights
+
+
+def instance_weights(y, reduce='max'):
+    # Return a weight for each row based on the weights of its classes
+    offsets, codes = _to_csr(y)
+    weights = class_weights(y)[codes]
+    if len(weights) == 0:
+        return np.zeros(len(offsets) - 1)
+
+    # Reduce the weights of each row, where rows may have no labels
+    nonempty = np.flatnonzero(np.diff(offsets) > 0)
+    starts = offsets[nonempty]
+    values = np.zeros(len(offsets) - 1)
+    if reduce == 'max':
+        values[nonempty] = np.maximum.reduceat(weights, starts)
+    elif reduce == 'sum':
+        values[nonempty] = np.add.reduceat(weights, starts)
+    elif reduce == 'mean':
+        values[nonempty] = (np.add.reduceat(weights, starts)
+                            / np.diff(offsets)[nonempty])
+    else:
+        raise ValueError(f'Invalid reduction: {reduce}')
+    return values
+
+
+def _to_csr(y):
+    # Return the (offsets, label codes) of a binary target matrix
+    if isinstance(y, SparseTargets):
+        rows = np.repeat(np.arange(len(y)), np.diff(y.offsets))
+        nonzero = np.asarray(y.values) != 0
+        return (_to_offsets(rows[nonzero], len(y)),
+                y.codes[nonzero].astype(np.int64))
+
+    y = _dense(y)
+    if hasattr(y, 'tocsr'):
+        y = y.tocsr()
+        y.eliminate_zeros()
+        return y.indptr.astype(np.int64), y.indices.astype(np.int64)
+
+    y = np.asarray(y)
+    if y.ndim == 3:
+        # Frame-level targets are reduced to clip-level targets
+        y = y.any(axis=1)
+    rows, codes = np.nonzero(y)
+    return _to_offsets(rows, len(y)), codes
+
+
+def _to_offsets(rows, n_rows):
+    return np.concatenate([[0], np.cumsum(np.bincount(
+        rows, minlength=n_rows))])
+
+
+def _dense(y):
+    # Return the class targets as an array, where targets with DOA
+    # arrays are (y, azimuth, elevation) tuples
+    if isinstance(y, DenseTargets):
+        y = y.arrays
+    if isinstance(y, tuple):
+        y = y[0]
+    if isinstance(y, pd.DataFrame):
+        y = y.values
+    return y
+
+
+def _n_classes(y):
+    return _dense(y).shape[-1]
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .labels import load_targets
+
+
+class SharedSubset:
+    # Read-only handle to the file names, audio paths, and targets of a
+    # DataSubset that can be shared by multiple processes
+    #
+    # There is one item for each audio clip of the subset, as in
+    # DataSubset.load_audio. If the subset has `start` and `end` private
+    # tags (e.g. segments), there is an item for each row, and the start
+    # and end times (in seconds) are exported too.
+    #
+    # The arrays are stored as .npy files and memory-mapped, so pickling
+    # a handle (e.g. to send it to a DataLoader worker) only transfers
+    # the directory path. As the arrays contain no Python objects, the
+    # pages are never copied by reference counting and are shared
+    # through the page cache. The targets are exported in the form of
+    # the target store of the subset (see DataSubset.target), e.g. the
+    # CSR arrays of multi-label targets, and are gathered for a batch
+    # of positions when indexed.
+    def __init__(self, path):
+        self.path = Path(path)
+        self._arrays = {
+            name: np.load(self.path / f'{name}.npy', mmap_mode='r')
+            for name in ['fnames', 'audio_paths', 'starts', 'ends']
+            if (self.path / f'{name}.npy').is_file()
+        }
+        self._target = None
+        if (self.path / 'target.json').is_file():
+            with open(self.path / 'target.json') as f:
+                meta = json.load(f)
+            self._target = load_targets(self.path / 'target', meta['type'],
+                                        meta['args'], mmap_mode='r')
+
+    @classmethod
+    def create(cls, subset, path=None, target=True, **kwargs):
+        owner = path is None
+        if owner:
+            # Prefer a memory-backed file system if there is one
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            path = tempfile.mkdtemp(prefix='jaffadata-', dir=shm_dir)
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        index = subset._index()
+        private_tags = subset._tags
+        paths = subset.audio_path_array
+        if 'start' in private_tags:
+            fnames = index.get_level_values(0)
+            codes, _ = pd.factorize(fnames)
+            paths = paths[codes]
+            np.save(path / 'starts.npy', private_tags['start'].values)
+            np.save(path / 'ends.npy', private_tags['end'].values)
+        else:
+            index = fnames = index.unique(level=0)
+        np.save(path / 'fnames.npy', np.asarray(fnames, dtype=str))
+        np.save(path / 'audio_paths.npy', paths)
+
+        if target:
+            _, (store, keys) = subset._target_store(kwargs)
+            if not keys.equals(index):
+                raise ValueError('The targets of the subset must be for '
+                                 'each audio clip (file or segment)')
+            meta = {'type': type(store).__name__,
+                    'args': store.save(path / 'target')}
+            with open(path / 'target.json', 'w') as f:
+                json.dump(meta, f)
+
+        shared = cls(path)
+        if owner:
+            # Remove the temporary files when the handle is collected
+            weakref.finalize(shared, _remove, path, os.getpid())
+        return shared
+
+    @property
+    def fnames(self):
+        return self._arrays['fnames']
+
+    @property
+    def audio_paths(self):
+        return self._arrays['audio_paths']
+
+    @property
+    def starts(self):
+        return self._arrays.get('starts')
+
+    @property
+    def ends(self):
+        return self._arrays.get('ends')
+
+    @property
+    def target(self):
+        if self._target is None:
+            raise AttributeError('Targets were not exported')
+        return self._target
+
+    def remove(self):
+        self._arrays = {}
+        self._target = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __getitem__(self, index):
+        if self._target is not None:
+            return self.audio_paths[index], self._target[index]
+        return self.audio_paths[index]
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+
+def _remove(path, pid):
+    # Processes created by forking inherit the finalizer of a handle,
+    # so only the process that created the files removes them
+    if os.getpid() == pid:
+        shutil.rmtree(path, ignore_errors=True)
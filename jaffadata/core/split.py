@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+from .multilabel import MultiLabelArray
+
+
+def assign_folds(subset, n_folds, stratify=None, groups=None, seed=None):
+    # Assign each row of a DataSubset to one of `n_folds` folds
+    #
+    # If `stratify` is the name of a (single- or multi-label) tag, the
+    # folds are stratified using iterative stratification [1]. Labels
+    # are processed from rarest to most common, and the examples of a
+    # label are distributed in one batch in proportion to how many of
+    # them each fold still needs. If `groups` is the name of a tag, rows
+    # with the same value are assigned to the same fold. For multi-index
+    # tags (e.g. frame-level tags), rows with the same first index level
+    # are always grouped together.
+    #
+    # [1] K. Sechidis, G. Tsoumakas, and I. Vlahavas, "On the
+    #     stratification of multi-label data," in ECML PKDD, 2011.
+    tags = subset.tags
+    rng = np.random.default_rng(seed)
+
+    # Determine the units (groups of rows) to assign to folds
+    if groups is not None:
+        units, _ = pd.factorize(tags[groups])
+        # Rows with a missing group are treated as separate groups
+        missing = units < 0
+        units[missing] = units.max(initial=-1) + 1 + np.arange(missing.sum())
+    elif tags.index.nlevels > 1:
+        units, _ = pd.factorize(tags.index.get_level_values(0))
+    else:
+        units = np.arange(len(tags))
+    n_units = units.max(initial=-1) + 1
+    sizes = np.bincount(units, minlength=n_units)
+
+    folds = np.full(n_units, -1)
+    desired_sizes = np.full(n_folds, len(tags) / n_folds)
+
+    if stratify is not None:
+        # Count the labels of each unit as (unit, label, count) triples
+        rows, codes, n_labels = _label_codes(tags[stratify])
+        pairs, counts = np.unique(units[rows] * n_labels + codes,
+                                  return_counts=True)
+        pair_units, pair_codes = np.divmod(pairs, n_labels)
+        unit_offsets = _offsets(pair_units, n_units)
+
+        # Index the units of each label (CSC order)
+        by_label = np.argsort(pair_codes, kind='stable')
+        label_offsets = _offsets(pair_codes[by_label], n_labels)
+
+        label_totals = np.bincount(pair_codes, counts, minlength=n_labels)
+        desired = np.outer(np.full(n_folds, 1 / n_folds), label_totals)
+
+        for label in np.argsort(label_totals, kind='stable'):
+            start, end = label_offsets[label], label_offsets[label + 1]
+            label_pairs = by_label[start:end]
+            label_units = pair_units[label_pairs]
+            unassigned = folds[label_units] < 0
+            if not unassigned.any():
+                continue
+
+            label_pairs = label_pairs[unassigned]
+            order = rng.permutation(len(label_pairs))
+            label_pairs = label_pairs[order]
+            label_units = pair_units[label_pairs]
+
+            # Prefer the folds that need the most examples of this label
+            weights = desired[:, label]
+            if (weights <= 0).all():
+                weights = desired_sizes
+            assigned = _allocate(weights, desired_sizes,
+                                 counts[label_pairs], rng)
+            folds[label_units] = assigned
+
+            # Update the number of examples each fold still needs
+            unit_pairs = _ranges(unit_offsets[label_units],
+                                 unit_offsets[label_units + 1])
+            n_unit_pairs = np.diff(unit_offsets)[label_units]
+            pair_folds = np.repeat(assigned, n_unit_pairs)
+            desired -= np.bincount(
+                pair_folds * n_labels + pair_codes[unit_pairs],
+                counts[unit_pairs], minlength=n_folds * n_labels,
+            ).reshape(n_folds, n_labels)
+            desired_sizes -= np.bincount(assigned, sizes[label_units],
+                                         minlength=n_folds)
+
+    # Distribute the remaining units according to their size
+    remaining = rng.permutation(np.flatnonzero(folds < 0))
+    folds[remaining] = _allocate(desired_sizes, desired_sizes,
+                                 sizes[remaining], rng)
+
+    return folds[units]
+
+
+def kfold(subset, n_folds, stratify=None, groups=None, seed=None):
+    # Return (training set, test set) pairs for each fold
+    # The subsets are lazy, so only the row positions are stored
+    folds = assign_folds(subset, n_folds, stratify, groups, seed)
+    return [(subset.subset(folds != fold), subset.subset(folds == fold))
+            for fold in range(n_folds)]
+
+
+def _label_codes(values):
+    # Return (row position, label code) pairs and the number of labels
+    values = values.array
+    if isinstance(values, MultiLabelArray):
+        codes = values.codes.astype(np.int64)
+        return values.rows(), codes, len(values.categories)
+
+    values = pd.Series(values)
+    if values.dtype == object:
+        values = values.explode()
+    codes, uniques = pd.factorize(values.values)
+    valid = codes >= 0
+    return values.index.values[valid], codes[valid], len(uniques)
+
+
+def _allocate(weights, priorities, sizes, rng):
+    # Split a sequence of items into contiguous chunks, one for each
+    # fold, such that the total size of each chunk is proportional to
+    # the (non-negative) weight of the fold
+    #
+    # Folds with a higher weight are given items first, with ties
+    # broken by priority and then randomly. This ensures that a single
+    # item is assigned to the fold that needs it the most.
+    order = np.lexsort((rng.random(len(weights)), -priorities, -weights))
+    weights = np.clip(weights[order], 0, None)
+    if weights.sum() == 0:
+        weights = np.ones_like(weights)
+    bounds = np.cumsum(weights) / weights.sum() * sizes.sum()
+    starts = np.cumsum(sizes) - sizes
+    chunks = np.searchsorted(bounds, starts, side='right')
+    return order[np.minimum(chunks, len(weights) - 1)]
+
+
+def _offsets(sorted_keys, n_keys):
+    counts = np.bincount(sorted_keys, minlength=n_keys)
+    return np.concatenate([[0], np.cumsum(counts)])
+
+
+def _ranges(starts, ends):
+    # Concatenate the ranges [start, end) without a Python loop
+    lengths = ends - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
@@ -4,6 +4,8 @@ import pandas as pd
 
 import jaffadata as jd
 from jaffadata import AudioDataset, DataSubset
+from jaffadata.core.cache import cached
+from jaffadata.core.profiling import instrument
 
 
 class _Arca23K(AudioDataset):
@@ -36,8 +38,8 @@ class _Arca23K(AudioDataset):
         self.label_set = sorted(train_tags.label.unique())
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'label', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'label', index, **kwargs)
 
 
 class Arca23K(_Arca23K):
@@ -71,6 +73,8 @@ class Arca23K_FSD(_Arca23K):
                          )
 
 
+@instrument()
+@cached(lambda path: [Path(path)])
 def read_tags(path):
     df = pd.read_csv(path, index_col=0, dtype={'label': 'category'})
     # Add missing file extension to file names
@@ -1,10 +1,17 @@
+import collections
 import functools
 import json
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 import jaffadata as jd
-from jaffadata import AudioDataset, DataSubset
+from jaffadata import AudioDataset, DataSubset, MultiLabelArray
+from jaffadata.core.cache import cached
+from jaffadata.core.dataset import Lazy
+from jaffadata.core.labels import encode, to_matrix
+from jaffadata.core.profiling import instrument
 
 
 class AudioSet(AudioDataset):
@@ -20,55 +27,183 @@ class AudioSet(AudioDataset):
 
         self.ontology = AudioSetOntology(self.root_dir / 'ontology.json')
 
-        # Read metadata from file
+        # Add DataSubsets, which are only created when first accessed
         #
         # Note that there is no official file structure for AudioSet.
         # This code assumes the metadata files are directly under the
         # root directory and that the audio files are in sub-folders.
-        bal_csv = self.root_dir / 'balanced_train_segments.csv'
-        unbal_csv = self.root_dir / 'unbalanced_train_segments.csv'
-        eval_csv = self.root_dir / 'eval_segments.csv'
-        bal_tags = read_tags(bal_csv, self.ontology)
-        unbal_tags = read_tags(unbal_csv, self.ontology)
-        eval_tags = read_tags(eval_csv, self.ontology)
-
-        # Add DataSubsets for training sets
-        bal_set = DataSubset('training/balanced', self, bal_tags,
-                             self.root_dir / 'balanced_train')
-        unbal_set = DataSubset('training/unbalanced', self, unbal_tags,
-                               self.root_dir / 'unbalanced_train')
-        train_set = jd.concat([bal_set, unbal_set], 'training')
-        self.add_subset(bal_set)
-        self.add_subset(unbal_set)
-        self.add_subset(train_set)
-
-        # Add DataSubset for evaluation/test set
-        self.add_subset(DataSubset('evaluation', self, eval_tags,
-                                   self.root_dir / 'eval'))
-
-        # Create alias
-        self['test'] = self['evaluation']
-
-        self.label_set = sorted(set(eval_tags.labels.sum()))
+        self['training/balanced'] = Lazy(
+            self._read_subset, 'training/balanced',
+            'balanced_train_segments.csv', 'balanced_train')
+        self['training/unbalanced'] = Lazy(
+            self._read_subset, 'training/unbalanced',
+            'unbalanced_train_segments.csv', 'unbalanced_train')
+        self['training'] = Lazy(self._training_set)
+        self['evaluation'] = Lazy(self._read_subset, 'evaluation',
+                                  'eval_segments.csv', 'eval')
+
+        # Create alias without creating the subset
+        self.subsets['test'] = self.subsets['evaluation']
+
+    @property
+    def label_set(self):
+        if self._label_set is None:
+            # Use the labels that appear in the evaluation set
+            eval_tags = self['evaluation'].tags
+            self._label_set = sorted(eval_tags.labels.array.unique_labels())
+        return self._label_set
+
+    @label_set.setter
+    def label_set(self, label_set):
+        self._label_set = label_set
+
+    def _read_subset(self, name, csv_name, audio_dir):
+        tags = read_tags(self.root_dir / csv_name, self.ontology)
+        return DataSubset(name, self, tags, self.root_dir / audio_dir)
+
+    def _training_set(self):
+        return jd.concat([self['training/balanced'],
+                          self['training/unbalanced']], 'training')
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'labels', index)
+    def target(subset, index=None, level=None, ancestors=False, **kwargs):
+        if level is None and not ancestors:
+            return jd.binarize(subset, 'labels', index, **kwargs)
+
+        # Use the ontology to determine targets for non-leaf labels
+        if index is not None:
+            subset = subset.subset_loc(np.atleast_1d(index))
+        return subset.dataset.ontology.target(subset, level=level,
+                                              ancestors=ancestors, **kwargs)
 
 
 class AudioSetOntology:
+    @instrument(rows=len)
     def __init__(self, path):
+        self.path = Path(path)
         with open(path, 'r') as f:
             ontology = json.load(f)
 
         # Create a dictionary of OntologyNodes where the keys are IDs
         self.nodes = {node['id']: OntologyNode(node) for node in ontology}
-        for node in self.nodes.values():
-            _visit_ontology(self.nodes, node)
+
+        # Set parent/child relationships
+        _link(self.nodes)
+
+        # Calculate level/depth of each node in topological order
+        # Note that a node may have more than one parent
+        self.order = _topological_order(self.nodes)
+        for node in self.order:
+            if len(node.parents) > 0:
+                node.level = max(parent.level for parent in node.parents) + 1
 
         # Create a dictionary where keys are labels
         self.nodes_by_name = {node.name: node for node in self.nodes.values()}
 
+        # Assign an integer index to each node and precompute the
+        # ancestors of each node as a boolean matrix, such that
+        # ancestors[i, j] is true if node j is an ancestor of node i
+        self.ids = list(self.nodes)
+        for index, node in enumerate(self.nodes.values()):
+            node.index = index
+            node.ontology = self
+        self.ancestors = _ancestor_matrix(self.order)
+
+    def is_ancestor(self, node, other):
+        return bool(self.ancestors[other.index, node.index])
+
+    def closure(self, keys=None):
+        # Return the reflexive ancestor matrix for the given labels/IDs
+        indices = self.indices(keys)
+        closure = self.ancestors[np.ix_(indices, indices)]
+        np.fill_diagonal(closure, True)
+        return closure
+
+    def indices(self, keys=None):
+        if keys is None:
+            return np.arange(len(self.ids))
+        return np.array([self[key].index for key in keys], dtype=int)
+
+    def node_ids(self, level=None):
+        if level is None:
+            return list(self.ids)
+        return [node_id for node_id in self.ids
+                if self.nodes[node_id].level == level]
+
+    @instrument()
+    def target(self, subset, tag_name='mids', level=None, ancestors=False,
+               fmt='frame', dtype=None):
+        # Return a (n_clips, n_nodes) target matrix in which the columns
+        # correspond to `node_ids(level)`
+        #
+        # If `level` is given, a clip is labelled with each node at that
+        # level that is one of its labels or an ancestor of one. If
+        # `ancestors` is true, the ancestors of each label are added.
+        tags = subset.tags
+        rows, codes = encode(tags[tag_name].array, self.ids)
+        node_ids = self.node_ids(level)
+        if fmt == 'sparse':
+            # Sparse matrix multiplication does not expand the ancestors
+            # shared by the labels of a clip, so it uses less memory
+            y = to_matrix(rows, codes, (len(tags), len(self.ids)),
+                          fmt, dtype)
+            if ancestors or level is not None:
+                y = self.propagate(y)
+            if level is not None:
+                y = y[:, self.indices(node_ids)]
+            return y
+
+        if ancestors or level is not None:
+            rows, codes = self._add_ancestors(rows, codes)
+        if level is not None:
+            # Map the codes to the columns of the nodes at the level
+            columns = np.full(len(self.ids), -1)
+            columns[self.indices(node_ids)] = np.arange(len(node_ids))
+            codes = columns[codes]
+            rows, codes = rows[codes >= 0], codes[codes >= 0]
+
+        shape = (len(tags), len(node_ids))
+        names = [self.nodes[node_id].name for node_id in node_ids]
+        return to_matrix(rows, codes, shape, fmt, dtype, tags.index, names)
+
+    def _add_ancestors(self, rows, codes):
+        # Add (row, ancestor code) pairs for the ancestors of each code
+        offsets, ancestor_codes = self._ancestor_lists
+        counts = np.diff(offsets)[codes]
+        starts = offsets[codes] - (np.cumsum(counts) - counts)
+        entries = np.repeat(starts, counts)
+        entries += np.arange(len(entries))
+        return np.repeat(rows, counts), ancestor_codes[entries]
+
+    @functools.cached_property
+    def _ancestor_lists(self):
+        # Return the reflexive ancestors of each node in CSR form
+        closure = self.closure()
+        offsets = np.concatenate([[0], np.cumsum(closure.sum(axis=1))])
+        return offsets, np.nonzero(closure)[1]
+
+    def propagate(self, y, keys=None):
+        # Add the ancestors of the labels to a (n_clips, n_labels) target
+        # matrix, where the columns correspond to the given labels/IDs
+        #
+        # Ancestors that are not in `keys` are not included. The matrix
+        # can be a DataFrame, a NumPy array, or a SciPy sparse matrix.
+        if isinstance(y, pd.DataFrame):
+            values = self.propagate(y.values, y.columns if keys is None
+                                    else keys)
+            return pd.DataFrame(values, index=y.index, columns=y.columns)
+
+        closure = self.closure(keys)
+        if hasattr(y, 'tocsr'):
+            import scipy.sparse as sp
+
+            closure = sp.csr_matrix(closure, dtype=np.int32)
+            propagated = y.tocsr().astype(bool).astype(np.int32) @ closure
+            propagated.data[:] = 1
+            return propagated.astype(y.dtype)
+
+        return (y.astype(bool) @ closure).astype(y.dtype)
+
     def __getitem__(self, key):
         if not isinstance(key, str):
             raise ValueError('`key` must be a string (label or ID)')
@@ -84,6 +219,14 @@ class AudioSetOntology:
         return '\n'.join([str(node.lineage[0])
                           for node in self.nodes.values()])
 
+    def __getstate__(self):
+        # The nodes are not pickled, as they are linked in a way that
+        # makes pickling deeply recursive, and the file is read again
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
 
 class OntologyNode:
     def __init__(self, info):
@@ -91,21 +234,20 @@ class OntologyNode:
         self.level = 0
         self.parents = []
         self.children = []
+        self.index = None
+        self.ontology = None
 
-        self._visiting = False
-        self._visited = False
+        self._lineage = None
 
     @functools.cached_property
     def lineage(self):
         return OntologyLineage(self)
 
     def is_ancestor(self, node):
-        if self.level < node.level:
-            for parent in node.parents:
-                if self is parent:
-                    return True
-                return self.is_ancestor(parent)
-        return False
+        if self.ontology is not None:
+            return self.ontology.is_ancestor(self, node)
+        return any(self is parent or self.is_ancestor(parent)
+                   for parent in node.parents)
 
     def is_descendant(self, node):
         return node.is_ancestor(self)
@@ -114,6 +256,10 @@ class OntologyNode:
         return self.info[key]
 
     def __getattr__(self, attr):
+        # Avoid infinite recursion if `info` has not been set yet (e.g.
+        # when unpickling) and make special methods resolve normally
+        if attr == 'info' or attr.startswith('__'):
+            raise AttributeError(attr)
         return self.info[attr]
 
     def __repr__(self):
@@ -143,7 +289,7 @@ class OntologyLine:
 
 class OntologyLineage:
     def __init__(self, node):
-        lineage = _lineage(node, [[node]])
+        lineage = _lineage(node)
         self.lineage = [OntologyLine(line) for line in lineage]
 
     def __getitem__(self, index):
@@ -156,50 +302,95 @@ class OntologyLineage:
         return '\n'.join(map(str, self.lineage))
 
 
+@instrument()
+@cached(lambda path, ontology: [Path(path), ontology.path])
 def read_tags(path, ontology):
-    def _to_label(mids):
-        return [ontology[mid].name for mid in mids]
-
     df = pd.read_csv(path, index_col=0, header=None, skipinitialspace=True,
                      skiprows=3, names=['start', 'end', 'mids'])
     fnames = [f'{name}.wav' for name in df.index]
     df.index = pd.Index(fnames, name='fname')
-    df['mids'] = df['mids'].str.split(',')
-    df['labels'] = df['mids'].apply(_to_label)
+    df['mids'] = MultiLabelArray.from_strings(df['mids'])
+    # Only the unique MIDs need to be mapped to their labels
+    df['labels'] = df['mids'].array.map_categories(
+        lambda mid: ontology[mid].name)
     return df
 
 
-def _visit_ontology(nodes, current_node):
-    if current_node._visiting:
+def _ancestor_matrix(order):
+    # Visit the nodes in topological order (parents before children)
+    # so that the ancestors of a node are the union of the ancestors of
+    # its parents and the parents themselves
+    ancestors = np.zeros((len(order), len(order)), dtype=bool)
+    for node in order:
+        for parent in node.parents:
+            ancestors[node.index] |= ancestors[parent.index]
+            ancestors[node.index, parent.index] = True
+    return ancestors
+
+
+def _link(nodes):
+    # Set the parents and children of each node by traversing the
+    # ontology depth-first, so that the parents of a node (and hence
+    # its lineage) are ordered by when they are first reached
+    visited = set()
+    for root in nodes.values():
+        if root.id in visited:
+            continue
+
+        visited.add(root.id)
+        stack = [(root, iter(root.child_ids))]
+        while stack:
+            node, child_ids = stack[-1]
+            child_id = next(child_ids, None)
+            if child_id is None:
+                stack.pop()
+                continue
+
+            child = nodes[child_id]
+            child.parents.append(node)
+            node.children.append(child)
+            if child.id not in visited:
+                visited.add(child.id)
+                stack.append((child, iter(child.child_ids)))
+
+
+def _topological_order(nodes):
+    # Sort the nodes using Kahn's algorithm, which runs in O(V + E)
+    n_parents = {node_id: len(node.parents) for node_id, node in nodes.items()}
+    queue = collections.deque(node for node in nodes.values()
+                              if len(node.parents) == 0)
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for child in node.children:
+            n_parents[child.id] -= 1
+            if n_parents[child.id] == 0:
+                queue.append(child)
+
+    if len(order) < len(nodes):
         raise RuntimeError('`nodes` contains loop (must be simple graph)')
-
-    # Calculate level/depth of node
-    # Note that a node may have more than one parent
-    if len(current_node.parents) > 0:
-        levels = [node.level for node in current_node.parents]
-        current_node.level = max(levels) + 1
-
-    current_node._visiting = True
-
-    # Visit ontology depth-first to set parent/child relationships
-    for child_id in current_node.child_ids:
-        child_node = nodes[child_id]
-        if not current_node._visited:
-            child_node.parents.append(current_node)
-            current_node.children.append(child_node)
-
-        _visit_ontology(nodes, child_node)
-
-    current_node._visiting = False
-    current_node._visited = True
-
-
-def _lineage(node, branches):
-    new_branches = []
-    for parent in node.parents:
-        for branch in branches:
-            new_branches += _lineage(parent, [[parent] + branch])
-
-    if len(new_branches) > 0:
-        return new_branches
-    return branches
+    return order
+
+
+def _lineage(node):
+    # Enumerate the paths from the root(s) to the node iteratively
+    #
+    # The paths of each visited node are cached, so the paths of a
+    # shared ancestor are only enumerated once.
+    stack = [node]
+    while stack:
+        current = stack[-1]
+        pending = [parent for parent in current.parents
+                   if parent._lineage is None]
+        if pending:
+            stack.extend(pending)
+            continue
+
+        stack.pop()
+        if current._lineage is None:
+            current._lineage = [line + [current]
+                                for parent in current.parents
+                                for line in parent._lineage] or [[current]]
+
+    return node._lineage
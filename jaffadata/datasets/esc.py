@@ -34,8 +34,8 @@ class _ESC(AudioDataset):
         return train_set, test_set
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'category', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'category', index, **kwargs)
 
 
 class ESC10(_ESC):
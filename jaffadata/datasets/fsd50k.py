@@ -1,7 +1,11 @@
+from pathlib import Path
+
 import pandas as pd
 
 import jaffadata as jd
-from jaffadata import AudioDataset, DataSubset
+from jaffadata import AudioDataset, DataSubset, MultiLabelArray
+from jaffadata.core.cache import cached
+from jaffadata.core.profiling import instrument
 
 
 class FSD50K(AudioDataset):
@@ -23,8 +27,8 @@ class FSD50K(AudioDataset):
         dev_dir = self.root_dir / 'FSD50K.dev_audio'
         dev_set = DataSubset('dev', self, dev_tags, dev_dir)
         # Split into training and validation sets
-        self.add_subset(dev_set.subset('train', dev_tags.split == 'train'))
-        self.add_subset(dev_set.subset('val', dev_tags.split == 'val'))
+        self.add_subset(dev_set.subset(dev_tags.split == 'train', 'train'))
+        self.add_subset(dev_set.subset(dev_tags.split == 'val', 'val'))
 
         # Create DataSubset for eval set
         eval_dir = self.root_dir / 'FSD50K.eval_audio'
@@ -41,15 +45,17 @@ class FSD50K(AudioDataset):
         self.label_set = sorted(vocab[1])
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'labels', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'labels', index, **kwargs)
 
 
+@instrument()
+@cached(lambda path: [Path(path)])
 def read_tags(path):
     df = pd.read_csv(path, index_col=0)
     # Add missing file extension to file names
     fnames = [f'{name}.wav' for name in df.index]
     df.index = pd.Index(fnames, name=df.index.name)
-    df['labels'] = df['labels'].str.split(',')
-    df['mids'] = df['mids'].str.split(',')
+    df['labels'] = MultiLabelArray.from_strings(df['labels'])
+    df['mids'] = MultiLabelArray.from_strings(df['mids'])
     return df
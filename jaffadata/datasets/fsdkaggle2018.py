@@ -1,7 +1,11 @@
+from pathlib import Path
+
 import pandas as pd
 
 import jaffadata as jd
 from jaffadata import AudioDataset, DataSubset
+from jaffadata.core.cache import cached
+from jaffadata.core.profiling import instrument
 
 
 class FSDKaggle2018(AudioDataset):
@@ -41,9 +45,11 @@ class FSDKaggle2018(AudioDataset):
         self.label_set = sorted(train_tags.label.unique())
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'label', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'label', index, **kwargs)
 
 
+@instrument()
+@cached(lambda path: [Path(path)])
 def read_tags(path):
     return pd.read_csv(path, index_col=0, dtype={'label': 'category'})
@@ -1,7 +1,11 @@
+from pathlib import Path
+
 import pandas as pd
 
 import jaffadata as jd
-from jaffadata import AudioDataset, DataSubset
+from jaffadata import AudioDataset, DataSubset, MultiLabelArray
+from jaffadata.core.cache import cached
+from jaffadata.core.profiling import instrument
 
 
 class FSDKaggle2019(AudioDataset):
@@ -54,11 +58,13 @@ class FSDKaggle2019(AudioDataset):
         self.label_set = sorted(vocab[1])
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'labels', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'labels', index, **kwargs)
 
 
+@instrument()
+@cached(lambda path: [Path(path)])
 def read_tags(path):
     df = pd.read_csv(path, index_col=0)
-    df['labels'] = df['labels'].str.split(',')
+    df['labels'] = MultiLabelArray.from_strings(df['labels'])
     return df
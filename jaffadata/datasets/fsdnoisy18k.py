@@ -33,5 +33,5 @@ class FSDnoisy18k(AudioDataset):
         self.label_set = sorted(train_tags.label.unique())
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'label', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'label', index, **kwargs)
@@ -1,8 +1,15 @@
+import functools
 import re
 
+import numpy as np
 import pandas as pd
 
 from jaffadata import AudioDataset, DataSubset
+from jaffadata.core.cache import cached
+from jaffadata.core.dataset import Lazy
+from jaffadata.core.labels import DenseTargets
+from jaffadata.core.parallel import imap
+from jaffadata.core.profiling import instrument
 
 
 LABEL_SET_2020 = [
@@ -40,7 +47,7 @@ LABEL_SET_2021 = [
 
 
 class TauNigens2020(AudioDataset):
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, n_workers=None):
         super().__init__('TAU-NIGENS 2020',
                          root_dir,
                          sample_rate=24000,
@@ -53,36 +60,45 @@ class TauNigens2020(AudioDataset):
         self.n_frames = 600
 
         # Create DataSubsets for dev set
-        dev_tags = read_dev_tags(self.root_dir / 'metadata_dev', ov=True)
+        # Subsets (and their tags) are only created when first accessed
+        dev_tags = Lazy(read_dev_tags, self.root_dir / 'metadata_dev',
+                        ov=True, n_workers=n_workers)
         for fmt_name in ['mic_dev', 'foa_dev']:
             audio_dir = self.root_dir / fmt_name
-            dataset = DataSubset('all', self, dev_tags, audio_dir)
-            self.add_subset(dataset.subset(f'{fmt_name}/training',
-                                           dev_tags.fold >= 3))
-            self.add_subset(dataset.subset(f'{fmt_name}/validation',
-                                           dev_tags.fold == 2))
-            self.add_subset(dataset.subset(f'{fmt_name}/test',
-                                           dev_tags.fold == 1))
+            dataset = Lazy(DataSubset, 'all', self, dev_tags, audio_dir)
+            self[f'{fmt_name}/training'] = Lazy(
+                DataSubset.subset, dataset, 'fold >= 3',
+                f'{fmt_name}/training')
+            self[f'{fmt_name}/validation'] = Lazy(
+                DataSubset.subset, dataset, 'fold = 2',
+                f'{fmt_name}/validation')
+            self[f'{fmt_name}/test'] = Lazy(
+                DataSubset.subset, dataset, 'fold = 1', f'{fmt_name}/test')
 
         # Create DataSubsets for eval set
-        eval_tags = read_eval_tags(self.root_dir / 'metadata_eval')
+        eval_tags = Lazy(read_eval_tags, self.root_dir / 'metadata_eval',
+                         n_workers=n_workers)
         for name in ['mic_eval', 'foa_eval']:
-            subset = DataSubset(name, self, eval_tags, self.root_dir / name)
-            self.add_subset(subset)
+            self[name] = Lazy(DataSubset, name, self, eval_tags,
+                              self.root_dir / name)
 
         # Set default training/validation/test sets
-        self['training'] = self['mic_dev/training']
-        self['validation'] = self['mic_dev/validation']
-        self['dev_test'] = self['mic_dev/test']
-        self['test'] = self['mic_eval']
+        self.subsets['training'] = self.subsets['mic_dev/training']
+        self.subsets['validation'] = self.subsets['mic_dev/validation']
+        self.subsets['dev_test'] = self.subsets['mic_dev/test']
+        self.subsets['test'] = self.subsets['mic_eval']
 
     @staticmethod
-    def target(subset, index=None):
-        return target(subset, index)
+    def target(subset, index=None, **kwargs):
+        return target(subset, index, **kwargs)
+
+    @staticmethod
+    def target_store(subset, **kwargs):
+        return target_store(subset, **kwargs)
 
 
 class TauNigens2021(AudioDataset):
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, n_workers=None):
         super().__init__('TAU-NIGENS 2021',
                          root_dir,
                          sample_rate=24000,
@@ -95,99 +111,245 @@ class TauNigens2021(AudioDataset):
         self.n_frames = 600
 
         # Create DataSubsets for dev set
+        # Subsets (and their tags) are only created when first accessed
         mapping = {
             'training': 'train',
             'validation': 'val',
             'test': 'test',
         }
+        dev_tags = {orig: Lazy(read_dev_tags,
+                               self.root_dir / f'metadata_dev/dev-{orig}',
+                               n_workers=n_workers)
+                    for orig in mapping.values()}
         for fmt_name in ['mic_dev', 'foa_dev']:
             for split, orig in mapping.items():
                 name = f'{fmt_name}/{split}'
-                metadata_dir = self.root_dir / f'metadata_dev/dev-{orig}'
-                tags = read_dev_tags(metadata_dir)
-                audio_dir = self.root_dir / fmt_name / 'dev-{orig}'
-                subset = DataSubset(name, self, tags, audio_dir)
-                self.add_subset(subset)
+                audio_dir = self.root_dir / fmt_name / f'dev-{orig}'
+                self[name] = Lazy(DataSubset, name, self, dev_tags[orig],
+                                  audio_dir)
 
         # Create DataSubsets for eval set
-        eval_tags = read_eval_tags(self.root_dir / 'metadata_eval')
+        eval_tags = Lazy(read_eval_tags, self.root_dir / 'metadata_eval',
+                         n_workers=n_workers)
         for name in ['mic_eval', 'foa_eval']:
             audio_dir = self.root_dir / name / 'eval-test'
-            subset = DataSubset(name, self, eval_tags, audio_dir)
-            self.add_subset(subset)
+            self[name] = Lazy(DataSubset, name, self, eval_tags, audio_dir)
 
         # Set default training/validation/test sets
-        self['training'] = self['mic_dev/training']
-        self['validation'] = self['mic_dev/validation']
-        self['dev_test'] = self['mic_dev/test']
-        self['test'] = self['mic_eval']
+        self.subsets['training'] = self.subsets['mic_dev/training']
+        self.subsets['validation'] = self.subsets['mic_dev/validation']
+        self.subsets['dev_test'] = self.subsets['mic_dev/test']
+        self.subsets['test'] = self.subsets['mic_eval']
+
+    @staticmethod
+    def target(subset, index=None, **kwargs):
+        return target(subset, index, **kwargs)
 
     @staticmethod
-    def target(subset, index=None):
-        return target(subset, index)
+    def target_store(subset, **kwargs):
+        return target_store(subset, **kwargs)
 
 
-def target(subset, index=None):
+def target(subset, index=None, fmt='frame', doa=False):
+    if 'start' in subset._tags:
+        return _segment_target(subset, index, fmt, doa)
+
     if index is None:
-        fnames = subset.tags.index.unique(level=0)
-        y = pd.concat([subset.target(idx) for idx in fnames], keys=fnames)
-        return y
+        tags = subset.tags
+        fnames = tags.index.unique(level=0)
+    else:
+        tags = subset.tags.loc[[index]]
+        fnames = pd.Index([index], name=tags.index.names[0])
+
+    dataset = subset.dataset
+    n_frames = dataset.n_frames
+    arrays = frame_targets(tags, fnames, n_frames,
+                           len(dataset.label_set), doa)
+
+    frame_index = None
+    if fmt == 'frame':
+        # Targets are flattened to DataFrames of shape
+        # (n_files * n_frames, n_classes) or (n_frames, n_classes) if
+        # a single file name is given
+        frame_index = pd.RangeIndex(n_frames, name=tags.index.names[1])
+        if index is None:
+            frame_index = pd.MultiIndex.from_product([fnames, frame_index])
+
+    return _format(arrays, fmt, frame_index, dataset.label_set,
+                   index is not None, doa)
+
+
+def target_store(subset, **kwargs):
+    # The targets of segments are for each row (segment), whereas the
+    # targets of the frame-level tags are for each file
+    keys = subset._index()
+    if 'start' not in subset._tags:
+        keys = keys.unique(level=0)
+    return DenseTargets(target(subset, fmt='array', **kwargs)), keys
+
+
+def _segment_target(subset, index=None, fmt='frame', doa=False):
+    # Return the frame-level targets of a subset created by segment(),
+    # with one (n_window, n_classes) array (or frame) per segment
+    if subset.frame_tags is None:
+        raise ValueError('The frame-level tags of the segments are missing')
+    if index is not None:
+        subset = subset.subset_loc([index])
+
+    dataset = subset.dataset
+    private_tags = subset._tags
+    frame_rate = dataset.n_frames / dataset.clip_duration
+    starts = np.round(private_tags['start'].values * frame_rate)
+    lengths = np.round(private_tags['end'].values * frame_rate) - starts
+    n_window = int(lengths.max(initial=0))
+    if (lengths != n_window).any():
+        raise ValueError('Segments must have the same duration')
+
+    fnames = subset.tags.index.get_level_values(0)
+    unique_fnames = fnames.unique()
+    arrays = frame_targets(subset.frame_tags, unique_fnames,
+                           dataset.n_frames, len(dataset.label_set), doa)
+    files = unique_fnames.get_indexer(fnames)
+    starts = starts.astype(np.int64)
+    arrays = [gather_windows(arr, files, starts, n_window)
+              if arr is not None else None for arr in arrays]
+
+    frame_index = None
+    if fmt == 'frame':
+        # Targets are flattened to DataFrames of shape
+        # (n_segments * n_window, n_classes) or (n_window, n_classes)
+        # if an index is given
+        frame_index = pd.RangeIndex(n_window,
+                                    name=subset.frame_tags.index.names[1])
+        if index is None:
+            segment_index = subset.tags.index.repeat(n_window)
+            frame_index = pd.MultiIndex.from_arrays(
+                [segment_index.get_level_values(0),
+                 segment_index.get_level_values(1),
+                 np.tile(frame_index, len(subset.tags))],
+                names=[*subset.tags.index.names, frame_index.name])
+
+    return _format(arrays, fmt, frame_index, dataset.label_set,
+                   index is not None, doa)
+
+
+def _format(arrays, fmt, frame_index, label_set, single, doa):
+    # Return the (y, azimuth, elevation) arrays in the given format
+    if fmt == 'frame':
+        arrays = [pd.DataFrame(arr.reshape(-1, arr.shape[-1]),
+                               index=frame_index, columns=label_set)
+                  if arr is not None else None for arr in arrays]
+    elif fmt == 'array':
+        if single:
+            arrays = [arr[0] if arr is not None else None for arr in arrays]
+    else:
+        raise ValueError(f'Invalid format: {fmt}')
+
+    if doa:
+        return tuple(arrays)
+    return arrays[0]
+
+
+def gather_windows(x, files, starts, n_window):
+    # Return the windows of shape (n_window, ...) of an array of shape
+    # (n_files, n_frames, ...) that start at the given frames of the
+    # given files
+    #
+    # Windows that extend past the last frame are padded with zeros
+    # (or NaN for floating-point arrays).
+    n_padding = starts.max(initial=0) + n_window - x.shape[1]
+    if n_padding > 0:
+        padding = [(0, 0), (0, n_padding)] + [(0, 0)] * (x.ndim - 2)
+        fill = np.nan if x.dtype.kind == 'f' else 0
+        x = np.pad(x, padding, constant_values=fill)
+
+    # Gather the frames of each window with a single indexing operation
+    frames = starts[:, None] + np.arange(n_window)
+    return x[files[:, None], frames]
+
+
+def frame_targets(tags, fnames, n_frames, n_classes, doa=False):
+    # Map each event to a (file, frame, class) position
+    file_index = fnames.get_indexer(tags.index.get_level_values(0))
+    frame_index = tags.index.get_level_values(1).values
+    class_index = tags.label.values
+    # Ignore events that fall outside of the target array
+    valid = ((file_index >= 0)
+             & (frame_index >= 0) & (frame_index < n_frames)
+             & (class_index >= 0) & (class_index < n_classes))
+    position = (file_index[valid], frame_index[valid], class_index[valid])
+
+    # Labels of events in the same frame are merged (OR)
+    shape = (len(fnames), n_frames, n_classes)
+    y = np.zeros(shape, dtype=np.uint8)
+    y[position] = 1
+
+    if not doa:
+        return y, None, None
+
+    # Inactive (frame, class) pairs have no direction of arrival
+    azimuth = np.full(shape, np.nan, dtype=np.float32)
+    elevation = np.full(shape, np.nan, dtype=np.float32)
+    azimuth[position] = tags.azimuth.values[valid]
+    elevation[position] = tags.elevation.values[valid]
+    return y, azimuth, elevation
+
+
+@instrument()
+@cached(lambda metadata_dir, ov=False, n_workers=None, processes=False:
+        [metadata_dir, ov] + sorted(metadata_dir.glob('fold*.csv')))
+def read_dev_tags(metadata_dir, ov=False, n_workers=None, processes=False):
+    return _concat(iter_dev_tags(metadata_dir, ov, n_workers, processes))
+
+
+@instrument()
+@cached(lambda metadata_dir, n_workers=None, processes=False:
+        [metadata_dir] + sorted(metadata_dir.glob('mix*.csv')))
+def read_eval_tags(metadata_dir, n_workers=None, processes=False):
+    return _concat(iter_eval_tags(metadata_dir, n_workers, processes))
+
+
+def iter_dev_tags(metadata_dir, ov=False, n_workers=None, processes=False):
+    paths = sorted(metadata_dir.glob('fold*.csv'))
+    read_fn = functools.partial(_read_dev_csv, ov=ov)
+    dfs = imap(read_fn, paths, n_workers, processes)
+    for path, df in zip(paths, dfs):
+        yield path.name.replace('csv', 'wav'), df
 
-    n_classes = len(subset.dataset.label_set)
-    y_columns = list(range(n_classes))
-    y_index = list(range(subset.dataset.n_frames))
-    y = subset.tags.loc[index]
 
-    y = binarize(y, y_index, y_columns)
-    y.columns = subset.dataset.label_set
-    return y
+def iter_eval_tags(metadata_dir, n_workers=None, processes=False):
+    paths = sorted(metadata_dir.glob('mix*.csv'))
+    dfs = imap(_read_csv, paths, n_workers, processes)
+    for path, df in zip(paths, dfs):
+        yield path.name.replace('csv', 'wav'), df
 
 
-def binarize(y, index, columns):
-    y = pd.get_dummies(y.label)
-    # Ensure y is not missing any columns
-    y = y.T.reindex(columns, fill_value=0).T
-    # Merge (OR) labels if they are for the same frame
-    y = y.groupby(y.index).max()
-    # Insert labels (zeros) for inactive frames
-    y = y.reindex(index, fill_value=0)  # (n_frames, n_classes)
-    return y
+def _read_csv(path):
+    columns = ['label', 'track', 'azimuth', 'elevation']
+    return pd.read_csv(path, index_col=0, header=None, names=columns)
 
 
-def read_dev_tags(metadata_dir, ov=False):
+def _read_dev_csv(path, ov=False):
     pattern_str = r'fold([0-9])_room([0-9])_mix([0-9]{3})'
     if ov:
         pattern_str += '_ov([0-9])'
-    pattern = re.compile(pattern_str)
 
-    def _read_df(path):
-        columns = ['label', 'track', 'azimuth', 'elevation']
-        df = pd.read_csv(path, index_col=0, header=None, names=columns)
+    df = _read_csv(path)
 
-        # Extract additional information from file name
-        match = pattern.match(str(path.name))
-        df['fold'] = int(match[1])
-        df['room'] = int(match[2])
-        df['mix'] = int(match[3])
-        if ov:
-            df['ov'] = int(match[4])
-
-        return df
+    # Extract additional information from file name
+    match = re.match(pattern_str, str(path.name))
+    df['fold'] = int(match[1])
+    df['room'] = int(match[2])
+    df['mix'] = int(match[3])
+    if ov:
+        df['ov'] = int(match[4])
 
-    paths = sorted(metadata_dir.glob('fold*.csv'))
-    df = pd.concat([_read_df(path) for path in paths],
-                   keys=[path.name.replace('csv', 'wav') for path in paths],
-                   names=['fname', 'frame_index'])
     return df
 
 
-def read_eval_tags(metadata_dir):
-    def _read_df(path):
-        columns = ['label', 'track', 'azimuth', 'elevation']
-        return pd.read_csv(path, index_col=0, header=None, names=columns)
-
-    paths = sorted(metadata_dir.glob('mix*.csv'))
-    df = pd.concat([_read_df(path) for path in paths],
-                   keys=[path.name.replace('csv', 'wav') for path in paths],
-                   names=['fname', 'frame_index'])
-    return df
+def _concat(items):
+    fnames, dfs = [], []
+    for fname, df in items:
+        fnames.append(fname)
+        dfs.append(df)
+    return pd.concat(dfs, keys=fnames, names=['fname', 'frame_index'])
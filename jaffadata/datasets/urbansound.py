@@ -36,5 +36,5 @@ class UrbanSound8K(AudioDataset):
         return train_set, test_set
 
     @staticmethod
-    def target(subset, index=None):
-        return jd.binarize(subset, 'class', index)
+    def target(subset, index=None, **kwargs):
+        return jd.binarize(subset, 'class', index, **kwargs)